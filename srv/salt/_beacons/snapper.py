@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+'''
+Beacon to watch the drift of a system from a snapper baseline snapshot
+
+Instead of running ``snapper.baseline_snapshot`` from frequent highstates,
+this beacon subscribes to the signals snapper sends over D-Bus
+(``SnapshotCreated``, ``SnapshotsDeleted``, ``ConfigModified``, ...) and only
+compares the system against the baseline snapshot when one of them is
+received for the watched configuration. An event is fired the first time the
+beacon runs and every time the set of files drifted from the baseline, or the
+baseline snapshot itself, changes.
+
+.. code-block:: yaml
+
+    beacons:
+      snapper:
+        - config: root
+        - tag: baseline
+        - ignore:
+          - /var/log
+          - /var/cache
+        - interval: 3600
+        - timeout: 10
+
+``number`` can be used instead of ``tag`` to watch a fixed snapshot. The
+events are fired with the ``salt/beacon/<minion>/snapper/<config>`` tag and
+can be used from a reactor to apply the baseline state only when needed:
+
+.. code-block:: yaml
+
+    reactor:
+      - 'salt/beacon/*/snapper/root':
+        - /srv/reactor/baseline.sls
+
+Snapper only signals changes to its snapshots, not files edited on the live
+system between two snapshots. With ``interval`` the drift is also checked
+every that many seconds without waiting for a signal, so the beacon can
+replace the highstates polling the baseline. Only the status of the files is
+compared, no diff is computed and nothing is undone.
+
+The comparison runs in the minion process, so it is given up after
+``timeout`` seconds (default is 10). An incomplete comparison fires no event
+and is retried after the next signal or ``interval``.
+
+:depends:       ``dbus`` and ``gi`` (GLib) Python modules.
+:maturity:      new
+:platform:      Linux
+'''
+
+from __future__ import absolute_import
+
+import hashlib
+import logging
+import time
+
+try:
+    import dbus  # pylint: disable=wrong-import-order
+    from dbus.mainloop.glib import DBusGMainLoop
+    from gi.repository import GLib
+    HAS_DBUS = True
+except ImportError:
+    HAS_DBUS = False
+
+
+SNAPPER_DBUS_OBJECT = 'org.opensuse.Snapper'
+SNAPPER_DBUS_PATH = '/org/opensuse/Snapper'
+SNAPPER_DBUS_INTERFACE = 'org.opensuse.Snapper'
+
+# Signals after which the drift from the baseline has to be checked again
+SNAPPER_SIGNALS = ('SnapshotCreated', 'SnapshotsDeleted', 'ConfigModified',
+                   'ConfigCreated', 'ConfigDeleted')
+
+# Default seconds given to every comparison against the baseline snapshot
+BEACON_TIMEOUT = 10
+
+__virtualname__ = 'snapper'
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+bus = None  # pylint: disable=invalid-name
+
+# Configurations with a received signal pending to be processed, the last
+# known baseline and drift of each configuration and when it was checked
+_PENDING = set()
+_DRIFT = {}
+_CHECKED = {}
+
+
+def __virtual__():
+    if not HAS_DBUS:
+        return (False, 'The snapper beacon cannot be loaded:'
+                ' missing python dbus or gi modules')
+    return __virtualname__
+
+
+def _on_signal(*args, **kwargs):
+    '''
+    Marks the configuration of a received snapper signal as pending
+    '''
+    if kwargs.get('member') in SNAPPER_SIGNALS and args:
+        _PENDING.add(str(args[0]))
+
+
+def _subscribe():
+    '''
+    Connects to the system bus and subscribes to the snapper signals.
+
+    A private connection is used, so the main loop needed to receive the
+    signals does not interfere with the connection of the execution module.
+    '''
+    global bus  # pylint: disable=global-statement,invalid-name
+    if bus is None:
+        bus = dbus.SystemBus(mainloop=DBusGMainLoop(), private=True)
+        bus.add_signal_receiver(_on_signal,
+                                dbus_interface=SNAPPER_DBUS_INTERFACE,
+                                path=SNAPPER_DBUS_PATH,
+                                member_keyword='member')
+
+
+def _process_signals():
+    '''
+    Dispatches the signals received since the last beacon run
+    '''
+    context = GLib.MainContext.default()
+    while context.pending():
+        context.iteration(False)
+
+
+def _merge_config(config):
+    '''
+    Returns the beacon configuration as a single dict
+    '''
+    if isinstance(config, list):
+        merged = {}
+        for item in config:
+            merged.update(item)
+        return merged
+    return config
+
+
+def __validate__(config):
+    '''
+    Validate the beacon configuration
+    '''
+    if not isinstance(config, (dict, list)):
+        return False, 'Configuration for snapper beacon must be a list or a dict.'
+    config = _merge_config(config)
+    if ('tag' in config) == ('number' in config):
+        return False, 'Configuration for snapper beacon needs either tag or number.'
+    if not isinstance(config.get('ignore', []), list):
+        return False, 'Configuration for snapper beacon ignore must be a list.'
+    for option in ('interval', 'timeout'):
+        if option in config:
+            try:
+                if float(config[option]) <= 0:
+                    raise ValueError
+            except (TypeError, ValueError):
+                return False, 'Configuration for snapper beacon {0} must be a positive number.'.format(option)
+    return True, 'Valid beacon configuration'
+
+
+def _get_baseline(config):
+    '''
+    Returns the number of the baseline snapshot, or None if there is none
+    '''
+    if 'number' in config:
+        return int(config['number'])
+    snapshots = __salt__['snapper.list_snapshots'](config.get('config', 'root'),
+                                                  userdata={'baseline_tag': config['tag']},
+                                                  order_by='timestamp',
+                                                  reverse=True, limit=1)
+    return snapshots[0]['id'] if snapshots else None
+
+
+def _get_drift(config, number):
+    '''
+    Returns the number of files drifted from the baseline snapshot and
+    a digest of their paths and status, or None if the comparison timed out
+    '''
+    ignore = tuple(config.get('ignore', []))
+    ret = __salt__['snapper.status'](config.get('config', 'root'),
+                                    num_pre=number, num_post=0, compact=True,
+                                    timeout=float(config.get('timeout', BEACON_TIMEOUT)))
+    if ret.get('incomplete'):
+        return None
+    grouped = ret['status']
+    files = sorted((dirname.rstrip('/') + '/' + name, bits)
+                   for dirname, names in grouped.items()
+                   for name, bits in names.items())
+    files = [item for item in files if not (ignore and item[0].startswith(ignore))]
+    digest = hashlib.sha256()
+    for path, bits in files:
+        digest.update('{0}:{1}\n'.format(path, bits).encode('utf-8'))
+    return len(files), digest.hexdigest()
+
+
+def beacon(config):
+    '''
+    Fires an event when the drift from the baseline snapshot changes
+
+    .. code-block:: yaml
+
+        beacons:
+          snapper:
+            - config: root
+            - tag: baseline
+            - interval: 3600
+    '''
+    config = _merge_config(config)
+    snapper_config = config.get('config', 'root')
+
+    _subscribe()
+    _process_signals()
+
+    now = time.time()
+    due = 'interval' in config and now - _CHECKED.get(snapper_config, 0) >= float(config['interval'])
+    if snapper_config in _CHECKED and snapper_config not in _PENDING and not due:
+        return []
+    _PENDING.discard(snapper_config)
+    _CHECKED[snapper_config] = now
+
+    number = None
+    try:
+        number = _get_baseline(config)
+        if number is None:
+            drift = {'baseline': None, 'files': 0, 'digest': None}
+        else:
+            result = _get_drift(config, number)
+            if result is None:
+                log.warning('Comparison against baseline snapshot %s timed out', number)
+                return []
+            drift = {'baseline': number, 'files': result[0], 'digest': result[1]}
+    except Exception as exc:  # pylint: disable=broad-except
+        log.error('Unable to compare against baseline snapshot %s: %s', number, exc)
+        return []
+
+    if _DRIFT.get(snapper_config) == drift:
+        return []
+    _DRIFT[snapper_config] = drift
+
+    event = {'tag': snapper_config, 'config': snapper_config, 'drift': drift['files'] > 0}
+    event.update(drift)
+    return [event]
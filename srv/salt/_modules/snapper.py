@@ -13,10 +13,23 @@ Module to manage filesystem snapshots with snapper
 
 from __future__ import absolute_import
 
+import base64
+import glob
+import hashlib
+import heapq
+import io
+import json
 import logging
 import os
+import re
+import stat
+import tarfile
+import tempfile
+import threading
 import time
 import difflib
+import zlib
+from multiprocessing.pool import ThreadPool
 from pwd import getpwuid
 
 from salt.exceptions import CommandExecutionError
@@ -42,21 +55,83 @@ DBUS_STATUS_MAP = {
     256: "ACL info changed",
 }
 
+# Status bits which imply a change of the file content. Any other bit only
+# reports a metadata change (permissions, ownership, xattrs or ACLs).
+DBUS_STATUS_CONTENT_MASK = 1 | 2 | 4 | 8
+
+# Size of the chunks read when comparing the content of two files
+FILE_CHUNK_SIZE = 64 * 1024
+
+# Smallest block size of the binary file deltas, and maximum number of blocks
+# kept in memory for a file: bigger files use bigger blocks
+DELTA_MIN_BLOCK_SIZE = 4 * 1024
+DELTA_MAX_BLOCKS = 64 * 1024
+
+# Maximum number of changed byte ranges returned for a binary file
+DELTA_MAX_RANGES = 100
+
+# Version of the diff() results, part of the diff cache keys
+DIFF_CACHE_VERSION = 2
+
+# Seconds a configuration is served from the per-process config cache, set
+# with the 'snapper.config_cache_ttl' minion option.
+CONFIG_CACHE_TTL = 60
+
+# Seconds a snapshot listing is shared between jobs through the minion
+# cachedir, set with the 'snapper.listing_cache_ttl' minion option (0
+# disables it). Listings are refreshed earlier when a snapshot is created or
+# deleted.
+LISTING_CACHE_TTL = 300
+
+# Default size limit in bytes of the on-disk diff cache. It can be changed
+# with the 'snapper.diff_cache_size' minion option, 0 disables the cache.
+DIFF_CACHE_SIZE = 64 * 1024 * 1024
+
+# Default size limit in bytes of the on-disk cache of comparisons between two
+# snapshots, set with the 'snapper.comparison_cache_size' minion option.
+COMPARISON_CACHE_SIZE = 64 * 1024 * 1024
+
+# Default size in bytes of the files stored in every archive part of an export
+EXPORT_PART_SIZE = 1024 * 1024 * 1024
+
+# Marker of the compact return format, decoded by the snapper runner
+COMPACT_FORMAT = 'snapper.compact/1'
+
 SNAPPER_DBUS_OBJECT = 'org.opensuse.Snapper'
 SNAPPER_DBUS_PATH = '/org/opensuse/Snapper'
 SNAPPER_DBUS_INTERFACE = 'org.opensuse.Snapper'
 
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
+# D-Bus calls done and bytes of snapshot files read in this process
+_COUNTERS = {'dbus_calls': 0, 'bytes_read': 0}
+
+
+class _CountingInterface(object):
+    '''
+    Wraps a D-Bus interface counting the method calls done through it
+    '''
+    def __init__(self, interface):
+        self._interface = interface
+
+    def __getattr__(self, name):
+        method = getattr(self._interface, name)
+
+        def _call(*args, **kwargs):
+            _COUNTERS['dbus_calls'] += 1
+            return method(*args, **kwargs)
+        return _call
+
+
 bus = None  # pylint: disable=invalid-name
 snapper = None  # pylint: disable=invalid-name
 
 if HAS_DBUS:
     bus = dbus.SystemBus()  # pylint: disable=invalid-name
     if SNAPPER_DBUS_OBJECT in bus.list_activatable_names():
-        snapper = dbus.Interface(bus.get_object(SNAPPER_DBUS_OBJECT,  # pylint: disable=invalid-name
-                                                SNAPPER_DBUS_PATH),
-                                 dbus_interface=SNAPPER_DBUS_INTERFACE)
+        snapper = _CountingInterface(  # pylint: disable=invalid-name
+            dbus.Interface(bus.get_object(SNAPPER_DBUS_OBJECT, SNAPPER_DBUS_PATH),
+                           dbus_interface=SNAPPER_DBUS_INTERFACE))
 
 
 def __virtual__():
@@ -69,9 +144,19 @@ def __virtual__():
     return 'snapper'
 
 
-def _snapshot_to_data(snapshot):
+# Cache of user names by uid, snapshots are usually created by a few users
+_USERNAMES = {}
+
+# Per-process cache of configurations, mapping their names to the time they
+# were retrieved and their (name, subvolume, values) D-Bus response, and
+# the time all of them were listed at once
+_CONFIGS = {}
+_CONFIGS_LISTED = {'time': None}
+
+
+class _Snapshot(object):
     '''
-    Returns snapshot data from a D-Bus response.
+    Read-only view of a snapshot D-Bus response.
 
     A snapshot D-Bus response is a dbus.Struct containing the
     information related to a snapshot:
@@ -87,28 +172,110 @@ def _snapshot_to_data(snapshot):
     description: dbus.String
     cleaup_algorithm: dbus.String
     userdata: dbus.Dictionary
+
+    Only a reference to the response is kept. The user name is resolved and
+    the userdata copied when the snapshot is converted to a dict, which is
+    only done for the snapshots returned by the public functions.
     '''
-    data = {}
+    __slots__ = ('_snapshot',)
+
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+
+    @property
+    def id(self):  # pylint: disable=invalid-name
+        return self._snapshot[0]
+
+    @property
+    def type(self):
+        return ['single', 'pre', 'post'][self._snapshot[1]]
+
+    @property
+    def pre(self):
+        return self._snapshot[2] if self._snapshot[1] == 2 else None
+
+    @property
+    def timestamp(self):
+        if self._snapshot[3] != -1:
+            return self._snapshot[3]
+        return int(time.time())
+
+    @property
+    def user(self):
+        uid = self._snapshot[4]
+        if uid not in _USERNAMES:
+            _USERNAMES[uid] = getpwuid(uid)[0]
+        return _USERNAMES[uid]
+
+    @property
+    def description(self):
+        return self._snapshot[5]
+
+    @property
+    def cleanup(self):
+        return self._snapshot[6]
+
+    @property
+    def userdata(self):
+        '''
+        The userdata of the D-Bus response, not a copy
+        '''
+        return self._snapshot[7]
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def to_dict(self):
+        '''
+        Returns the snapshot data as returned by the execution module
+        '''
+        data = {
+            'id': self.id,
+            'type': self.type,
+            'timestamp': self.timestamp,
+            'user': self.user,
+            'description': self.description,
+            'cleanup': self.cleanup,
+            'userdata': dict(self.userdata.items()),
+        }
+        if data['type'] == 'post':
+            data['pre'] = self.pre
+        return data
 
-    data['id'] = snapshot[0]
-    data['type'] = ['single', 'pre', 'post'][snapshot[1]]
-    if data['type'] == 'post':
-        data['pre'] = snapshot[2]
 
-    if snapshot[3] != -1:
-        data['timestamp'] = snapshot[3]
-    else:
-        data['timestamp'] = int(time.time())
-
-    data['user'] = getpwuid(snapshot[4])[0]
-    data['description'] = snapshot[5]
-    data['cleanup'] = snapshot[6]
+def _snapshot_to_data(snapshot):
+    '''
+    Returns snapshot data from a D-Bus response.
+    '''
+    return _Snapshot(snapshot).to_dict()
 
-    data['userdata'] = {}
-    for key, value in snapshot[7].items():
-        data['userdata'][key] = value
 
-    return data
+def _snapshot_matches(snapshot, snapshot_type=None, start_time=None, end_time=None,
+                      cleanup=None, userdata=None, min_id=None, max_id=None):
+    '''
+    Checks a snapshot D-Bus response against the list_snapshots filters
+    without converting it
+    '''
+    if snapshot_type is not None and \
+            ['single', 'pre', 'post'][snapshot[1]] != snapshot_type:
+        return False
+    if min_id is not None and snapshot[0] < int(min_id):
+        return False
+    if max_id is not None and snapshot[0] > int(max_id):
+        return False
+    if start_time is not None or end_time is not None:
+        timestamp = snapshot[3] if snapshot[3] != -1 else int(time.time())
+        if start_time is not None and timestamp < int(start_time):
+            return False
+        if end_time is not None and timestamp > int(end_time):
+            return False
+    if cleanup is not None and snapshot[6] != cleanup:
+        return False
+    if userdata:
+        for key, value in userdata.items():
+            if key not in snapshot[7] or snapshot[7][key] != value:
+                return False
+    return True
 
 
 def _dbus_exception_to_reason(exc, args):
@@ -124,25 +291,91 @@ def _dbus_exception_to_reason(exc, args):
         return exc.get_dbus_name()
 
 
-def list_snapshots(config='root'):
+def list_snapshots(config='root', snapshot_type=None, start_time=None, end_time=None,
+                   cleanup=None, userdata=None, min_id=None, max_id=None,
+                   order_by=None, reverse=False, limit=None):
     '''
     List available snapshots
 
+    config
+        Configuration name.
+
+    snapshot_type
+        Only list snapshots of this type: single, pre or post.
+
+    start_time, end_time
+        Only list snapshots created in this time range (unix timestamps).
+
+    cleanup
+        Only list snapshots with this cleanup algorithm.
+
+    userdata
+        Only list snapshots whose userdata contains all these key-value pairs.
+
+    min_id, max_id
+        Only list snapshots in this range of snapshot numbers.
+
+    order_by
+        Sort the snapshots by ``id`` or ``timestamp``. Default is the order
+        given by snapper.
+
+    reverse
+        Sort the snapshots in descending order. Default is False
+
+    limit
+        Maximum number of snapshots to return.
+
     CLI example:
 
     .. code-block:: bash
 
         salt '*' snapper.list_snapshots config=myconfig
+        salt '*' snapper.list_snapshots snapshot_type=pre order_by=id reverse=True limit=5
+        salt '*' snapper.list_snapshots userdata='{baseline_tag: baseline}'
+    '''
+    return [s.to_dict() for s in _list_snapshots(config, snapshot_type, start_time,
+                                                 end_time, cleanup, userdata, min_id,
+                                                 max_id, order_by, reverse, limit)]
+
+
+def _list_snapshots(config='root', snapshot_type=None, start_time=None, end_time=None,
+                    cleanup=None, userdata=None, min_id=None, max_id=None,
+                    order_by=None, reverse=False, limit=None):
     '''
+    Returns the snapshots matching the list_snapshots filters as _Snapshot
+    records
+    '''
+    if order_by not in (None, 'id', 'timestamp'):
+        raise CommandExecutionError(
+            "Invalid order '{0}', use 'id' or 'timestamp'".format(order_by))
+
     try:
-        snapshots = snapper.ListSnapshots(config)
-        return [_snapshot_to_data(s) for s in snapshots]
+        snapshots = [s for s in _get_snapshots(config)
+                     if _snapshot_matches(s, snapshot_type, start_time, end_time,
+                                          cleanup, userdata, min_id, max_id)]
     except dbus.DBusException as exc:
         raise CommandExecutionError(
             'Error encountered while listing snapshots: {0}'
             .format(_dbus_exception_to_reason(exc, locals()))
         )
 
+    if order_by is not None:
+        now = int(time.time())
+
+        def key(snapshot):
+            if order_by == 'id':
+                return snapshot[0]
+            return (snapshot[3] if snapshot[3] != -1 else now, snapshot[0])
+
+        if limit is not None:
+            select = heapq.nlargest if reverse else heapq.nsmallest
+            snapshots = select(int(limit), snapshots, key=key)
+        else:
+            snapshots = sorted(snapshots, key=key, reverse=reverse)
+    if limit is not None:
+        snapshots = snapshots[:int(limit)]
+    return [_Snapshot(s) for s in snapshots]
+
 
 def get_snapshot(number=0, config='root'):
     '''
@@ -174,8 +407,16 @@ def list_configs():
 
         salt '*' snapper.list_configs
     '''
+    now = time.time()
+    if _CONFIGS_LISTED['time'] is not None and \
+            now - _CONFIGS_LISTED['time'] <= _config_cache_ttl():
+        return dict((name, entry[1][2]) for name, entry in _CONFIGS.items())
     try:
         configs = snapper.ListConfigs()
+        _CONFIGS.clear()
+        for config in configs:
+            _CONFIGS[config[0]] = (now, config)
+        _CONFIGS_LISTED['time'] = now
         return dict((config[0], config[2]) for config in configs)
     except dbus.DBusException as exc:
         raise CommandExecutionError(
@@ -184,21 +425,60 @@ def list_configs():
         )
 
 
+def _config_cache_ttl():
+    '''
+    Returns the number of seconds the configurations are cached
+    '''
+    return float(__opts__.get('snapper.config_cache_ttl', CONFIG_CACHE_TTL))
+
+
+def _get_config(name):
+    '''
+    Returns the (name, subvolume, values) D-Bus response of a configuration,
+    from the config cache if it has not expired
+    '''
+    entry = _CONFIGS.get(name)
+    if entry is None or time.time() - entry[0] > _config_cache_ttl():
+        entry = (time.time(), snapper.GetConfig(name))
+        _CONFIGS[name] = entry
+    return entry[1]
+
+
+def _update_cached_config(name, data):
+    '''
+    Applies the values written with SetConfig to the config cache
+    '''
+    if name in _CONFIGS:
+        timestamp, config = _CONFIGS[name]
+        values = dict(config[2])
+        values.update(data)
+        _CONFIGS[name] = (timestamp, (config[0], config[1], values))
+
+
 def _config_filter(value):
     if isinstance(value, bool):
         return 'yes' if value else 'no'
-    return value
+    return str(value)
 
 
 def set_config(name='root', **kwargs):
     '''
     Set configuration values
 
+    name
+        Configuration name, or a list of configuration names to set the
+        same values on all of them.
+
+    Only the values which differ from the current configuration are written.
+    Returns a dict with the old and new values changed in every
+    configuration.
+
     CLI example:
 
     .. code-block:: bash
 
         salt '*' snapper.set_config SYNC_ACL=True
+        salt '*' snapper.set_config name='[root, home]' NUMBER_LIMIT=10
 
     Keys are case insensitive as they will be always uppercased to
     snapper convention. The above example is equivalent to:
@@ -206,24 +486,54 @@ def set_config(name='root', **kwargs):
     .. code-block:: bash
         salt '*' snapper.set_config sync_acl=True
     '''
-    try:
-        data = dict((k.upper(), _config_filter(v)) for k, v in
-                    kwargs.items() if not k.startswith('__'))
-        snapper.SetConfig(name, data)
-    except dbus.DBusException as exc:
-        raise CommandExecutionError(
-            'Error encountered while setting configuration {0}: {1}'
-            .format(name, _dbus_exception_to_reason(exc, locals()))
-        )
-    return True
+    names = name if isinstance(name, (list, tuple)) else [name]
+    data = dict((k.upper(), _config_filter(v)) for k, v in
+                kwargs.items() if not k.startswith('__'))
+
+    ret = {}
+    for config_name in names:
+        try:
+            current = _get_config(config_name)[2]
+            changes = dict((k, v) for k, v in data.items() if current.get(k) != v)
+            if changes:
+                snapper.SetConfig(config_name, changes)
+        except dbus.DBusException as exc:
+            raise CommandExecutionError(
+                'Error encountered while setting configuration {0}: {1}'
+                .format(config_name, _dbus_exception_to_reason(exc, locals()))
+            )
+        _update_cached_config(config_name, changes)
+        ret[config_name] = dict((k, {'old': current.get(k), 'new': v})
+                                for k, v in changes.items())
+    return ret
 
 
 def _get_last_snapshot(config='root'):
     '''
     Returns the last existing created snapshot
     '''
-    snapshot_list = sorted(list_snapshots(config), key=lambda x: x['id'])
-    return snapshot_list[-1]
+    return _list_snapshots(config, order_by='id', reverse=True, limit=1)[0]
+
+
+def get_counters(reset=False):
+    '''
+    Returns the number of D-Bus calls done and bytes of snapshot files read
+    by the snapper module in the current process
+
+    reset
+        Set the counters back to zero after reading them. Default is False
+
+    CLI example:
+
+    .. code-block:: bash
+
+        salt '*' snapper.get_counters
+    '''
+    counters = dict(_COUNTERS)
+    if reset:
+        for key in _COUNTERS:
+            _COUNTERS[key] = 0
+    return counters
 
 
 def status_to_string(dbus_status):
@@ -243,6 +553,10 @@ def get_config(name='root'):
     '''
     Retrieves all values from a given configuration
 
+    Configurations are cached for ``snapper.config_cache_ttl`` seconds
+    (60 by default), changes done with ``snapper.set_config`` are applied
+    to the cache right away.
+
     CLI example:
 
     .. code-block:: bash
@@ -250,8 +564,7 @@ def get_config(name='root'):
       salt '*' snapper.get_config
     '''
     try:
-        config = snapper.GetConfig(name)
-        return config
+        return _get_config(name)
     except dbus.DBusException as exc:
         raise CommandExecutionError(
             'Error encountered while retrieving configuration: {0}'
@@ -327,6 +640,7 @@ def create_snapshot(config='root', snapshot_type='single', pre_number=None,
             'Error encountered while listing changed files: {0}'
             .format(_dbus_exception_to_reason(exc, locals()))
         )
+    _listing_invalidate(config)
     return new_nr
 
 
@@ -339,6 +653,546 @@ def _get_num_interval(config, num_pre, num_post):
     return pre, post
 
 
+def _group_by_dir(files):
+    '''
+    Groups a dict keyed by absolute paths into a dict of directories, each
+    one mapping the file names to their original values
+    '''
+    grouped = {}
+    for path, value in files.items():
+        dirname, basename = os.path.split(path)
+        grouped.setdefault(dirname, {})[basename] = value
+    return grouped
+
+
+def _compress_text(text):
+    '''
+    Returns the zlib compressed text encoded as base64
+    '''
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    return base64.b64encode(zlib.compress(text)).decode('ascii')
+
+
+def _compact_diff(files_diff):
+    '''
+    Returns the compact format of a diff() result
+    '''
+    compact = {}
+    for path, file_diff in files_diff.items():
+        file_diff = dict(file_diff)
+        if 'diff' in file_diff:
+            file_diff['diff'] = _compress_text(file_diff['diff'])
+        compact[path] = file_diff
+    return {'format': COMPACT_FORMAT, 'diff': _group_by_dir(compact)}
+
+
+def _get_files_status(config, pre, post, proxy=None):
+    '''
+    Returns a dict mapping every file changed between two snapshots to
+    its numeric dbus snapper status
+
+    Comparisons between two existing snapshots never change, so they are
+    kept in the minion cachedir and only requested once to snapper.
+    '''
+    proxy = proxy or snapper
+    pre, post = int(pre), int(post)
+
+    timestamps = None
+    if pre and post and _comparison_path(config, pre, post):
+        if proxy is snapper:
+            timestamps = (_get_timestamp(config, pre), _get_timestamp(config, post))
+        else:
+            timestamps = (proxy.GetSnapshot(config, pre)[3], proxy.GetSnapshot(config, post)[3])
+        files = _load_comparison(config, pre, post, timestamps)
+        if files is not None:
+            return files
+
+    proxy.CreateComparison(config, pre, post)
+    files = dict((file[0], int(file[1])) for file in proxy.GetFiles(config, pre, post))
+
+    if timestamps:
+        _save_comparison(config, pre, post, timestamps, files)
+    return files
+
+
+def _private_proxy():
+    '''
+    Returns a private D-Bus connection and a snapper proxy using it, to be
+    used from threads other than the one of the job
+    '''
+    private_bus = dbus.SystemBus(private=True)
+    proxy = _CountingInterface(
+        dbus.Interface(private_bus.get_object(SNAPPER_DBUS_OBJECT, SNAPPER_DBUS_PATH),
+                       dbus_interface=SNAPPER_DBUS_INTERFACE))
+    return private_bus, proxy
+
+
+def _background_comparison(config, pre, post):
+    '''
+    Compares two snapshots and stores the result in the comparison cache.
+
+    Runs in its own thread, using a private D-Bus connection.
+    '''
+    private_bus = None
+    try:
+        private_bus, proxy = _private_proxy()
+        _get_files_status(config, pre, post, proxy=proxy)
+    except Exception as exc:  # pylint: disable=broad-except
+        log.warning('Background comparison of snapshots %s..%s failed: %s', pre, post, exc)
+    finally:
+        if private_bus is not None:
+            private_bus.close()
+
+
+class _Deadline(object):
+    '''
+    Deadline of a call given a timeout in seconds, None meaning no deadline
+    '''
+    def __init__(self, timeout=None):
+        self.end = time.time() + float(timeout) if timeout is not None else None
+
+    def remaining(self):
+        '''
+        Returns the seconds left, or None without a deadline
+        '''
+        return max(self.end - time.time(), 0) if self.end is not None else None
+
+    def expired(self):
+        '''
+        Returns True if the deadline has passed
+        '''
+        return self.end is not None and time.time() >= self.end
+
+
+def _get_files_status_until(config, pre, post, deadline):
+    '''
+    Like _get_files_status, returning None if snapper does not finish the
+    comparison before the deadline.
+
+    The comparison runs in a daemon thread with a private D-Bus connection.
+    After the deadline the thread is abandoned, so the job process can exit
+    and snapper releases the comparison when the connection is closed.
+    '''
+    if deadline.end is None:
+        return _get_files_status(config, pre, post)
+
+    result = {}
+
+    def _compare():
+        private_bus = None
+        try:
+            private_bus, proxy = _private_proxy()
+            result['files'] = _get_files_status(config, pre, post, proxy=proxy)
+        except Exception as exc:  # pylint: disable=broad-except
+            result['error'] = exc
+        finally:
+            if private_bus is not None:
+                private_bus.close()
+
+    thread = threading.Thread(target=_compare,
+                              name='snapper-comparison-{0}-{1}-{2}'.format(config, pre, post))
+    thread.daemon = True
+    thread.start()
+    thread.join(deadline.remaining())
+    if thread.is_alive():
+        return None
+    if 'error' in result:
+        raise result['error']
+    return result['files']
+
+
+def _mount_snapshot(config, number):
+    '''
+    Returns the path where the files of a snapshot can be read, snapshot 0
+    being the current system.
+
+    The paths returned by GetFiles are relative to the subvolume of the
+    configuration. Btrfs snapshots are subvolumes which are always
+    accessible, so they are not mounted through snapper.
+    '''
+    _, subvolume, values = _get_config(config)
+    if not number:
+        return subvolume.rstrip('/')
+    if values.get('FSTYPE') == 'btrfs':
+        return os.path.join(subvolume, '.snapshots', str(number), 'snapshot')
+    return snapper.MountSnapshot(config, number, False)
+
+
+def _umount_snapshot(config, number):
+    '''
+    Releases a snapshot mounted by _mount_snapshot
+    '''
+    if number and _get_config(config)[2].get('FSTYPE') != 'btrfs':
+        snapper.UmountSnapshot(config, number, False)
+
+
+# Priority already applied to the job process by _Throttle.renice
+_RENICED = {}
+
+
+class _Throttle(object):
+    '''
+    Limits the resources used to compare and restore files.
+
+    Settings, given per call or with the ``snapper.throttle`` minion option:
+
+    nice
+        Niceness of the process comparing the files and of the
+        ``snapper undochange`` processes.
+    ionice
+        I/O scheduling class: ``idle`` or ``best-effort``.
+    bytes_per_second
+        Maximum number of bytes per second read from the compared files.
+    files_per_second
+        Maximum number of files compared per second. It does not apply to
+        ``snapper undochange``, which restores all the files in one call.
+    '''
+    IONICE_CLASSES = {'idle': 3, 'best-effort': 2}
+
+    def __init__(self, settings):
+        unknown = set(settings) - set(['nice', 'ionice', 'bytes_per_second', 'files_per_second'])
+        if unknown:
+            raise CommandExecutionError(
+                'Unknown throttle settings: {0}'.format(', '.join(sorted(unknown))))
+        if settings.get('ionice') is not None and settings['ionice'] not in self.IONICE_CLASSES:
+            raise CommandExecutionError(
+                "Invalid ionice class '{0}', use idle or best-effort".format(settings['ionice']))
+        self.nice = settings.get('nice')
+        self.ionice = self.IONICE_CLASSES.get(settings.get('ionice'))
+        self.bytes_per_second = settings.get('bytes_per_second')
+        self.files_per_second = settings.get('files_per_second')
+        self.start = time.time()
+        self.bytes = 0
+        self.files = 0
+        self.slept = 0.0
+        self._lock = threading.Lock()
+
+    def _wait(self, done, rate):
+        delay = done / float(rate) - (time.time() - self.start)
+        if delay > 0:
+            time.sleep(delay)
+            self.slept += delay
+
+    def read(self, size):
+        '''
+        Accounts `size` read bytes, waiting to keep under the byte rate
+        '''
+        with self._lock:
+            self.bytes += size
+            if self.bytes_per_second:
+                self._wait(self.bytes, self.bytes_per_second)
+
+    def file(self, count=1, wait=True):
+        '''
+        Accounts `count` processed files, waiting to keep under the file rate
+        '''
+        with self._lock:
+            self.files += count
+            if wait and self.files_per_second:
+                self._wait(self.files, self.files_per_second)
+
+    def renice(self):
+        '''
+        Applies the nice and ionice settings to the current process.
+
+        The priority cannot be raised back by an unprivileged process and
+        the job may run several diffs, so it is applied once per process and
+        kept for the rest of the job.
+        '''
+        if self.nice is None and self.ionice is None:
+            return
+        if not __opts__.get('multiprocessing', True):
+            log.warning('Not changing the priority of the minion process, '
+                        'the minion does not run jobs in their own processes')
+            return
+        if _RENICED.get('pid') != os.getpid():
+            _RENICED.clear()
+            _RENICED['pid'] = os.getpid()
+        if self.nice is not None and _RENICED.get('nice') != self.nice:
+            # os.nice is relative, only raise the niceness up to the setting
+            current = os.nice(0)
+            if int(self.nice) > current:
+                os.nice(int(self.nice) - current)
+            _RENICED['nice'] = self.nice
+        if self.ionice is not None and _RENICED.get('ionice') != self.ionice:
+            __salt__['cmd.run_all']('ionice -c {0} -p {1}'.format(self.ionice, os.getpid()),
+                                    python_shell=False)
+            _RENICED['ionice'] = self.ionice
+
+    def command(self, cmd):
+        '''
+        Returns the command wrapped to run with the nice and ionice settings
+        '''
+        if self.ionice is not None:
+            cmd = 'ionice -c {0} {1}'.format(self.ionice, cmd)
+        if self.nice is not None:
+            cmd = 'nice -n {0} {1}'.format(int(self.nice), cmd)
+        return cmd
+
+    def report(self):
+        '''
+        Returns the achieved throughput
+        '''
+        elapsed = max(time.time() - self.start, 0.001)
+        return {'bytes': self.bytes,
+                'files': self.files,
+                'time': round(elapsed, 3),
+                'slept': round(self.slept, 3),
+                'bytes_per_second': int(self.bytes / elapsed),
+                'files_per_second': round(self.files / elapsed, 2)}
+
+
+def _get_throttle(throttle=None):
+    '''
+    Returns a _Throttle for the ``snapper.throttle`` minion option updated
+    with the given settings, or None if there is nothing to throttle
+    '''
+    settings = dict(__opts__.get('snapper.throttle') or {})
+    settings.update(throttle or {})
+    return _Throttle(settings) if settings else None
+
+
+def _read_lines(filename, throttle=None):
+    '''
+    Returns the lines of a file
+    '''
+    with salt.utils.fopen(filename) as file_:
+        lines = file_.readlines()
+    size = sum(len(line) for line in lines)
+    _COUNTERS['bytes_read'] += size
+    if throttle:
+        throttle.read(size)
+    return lines
+
+
+def _same_content(pre_file, post_file, throttle=None):
+    '''
+    Checks if two files have the same content.
+
+    Files with a different size are reported as different without reading
+    them, otherwise both files are compared chunk by chunk, stopping at the
+    first chunk that differs.
+    '''
+    try:
+        if os.stat(pre_file).st_size != os.stat(post_file).st_size:
+            return False
+        with salt.utils.fopen(pre_file, 'rb') as pre_fd:
+            with salt.utils.fopen(post_file, 'rb') as post_fd:
+                while True:
+                    pre_chunk = pre_fd.read(FILE_CHUNK_SIZE)
+                    post_chunk = post_fd.read(FILE_CHUNK_SIZE)
+                    _COUNTERS['bytes_read'] += len(pre_chunk) + len(post_chunk)
+                    if throttle:
+                        throttle.read(len(pre_chunk) + len(post_chunk))
+                    if pre_chunk != post_chunk:
+                        return False
+                    if not pre_chunk:
+                        return True
+    except (IOError, OSError):
+        return False
+
+
+def _file_digest(filename, throttle=None):
+    '''
+    Returns the sha256 digest of a file, or None if it is not a regular file
+    '''
+    if not os.path.isfile(filename):
+        return None
+    digest = hashlib.sha256()
+    with salt.utils.fopen(filename, 'rb') as file_:
+        while True:
+            chunk = file_.read(FILE_CHUNK_SIZE)
+            if not chunk:
+                break
+            _COUNTERS['bytes_read'] += len(chunk)
+            if throttle:
+                throttle.read(len(chunk))
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _delta_block_size(size):
+    '''
+    Returns the block size of a binary delta, a power of two keeping the
+    number of blocks under DELTA_MAX_BLOCKS
+    '''
+    block_size = DELTA_MIN_BLOCK_SIZE
+    while size > block_size * DELTA_MAX_BLOCKS:
+        block_size *= 2
+    return block_size
+
+
+def _roll_adler32(checksum, out_byte, in_byte, block_size):
+    '''
+    Returns the adler32 checksum of a window moved one byte forward
+    '''
+    low = ((checksum & 0xffff) - out_byte + in_byte) % 65521
+    high = ((checksum >> 16) - block_size * out_byte + low - 1) % 65521
+    return (high << 16) | low
+
+
+def _binary_delta(pre_file, post_file, throttle=None):
+    '''
+    Compares two binary files by blocks, the way rsync does, reading each
+    file once.
+
+    The pre file is split in blocks, indexed by their adler32 and md5
+    checksums. The post file is then scanned looking up every block in that
+    index. When a block is not found, the window is rolled forward one byte
+    at a time, for at most a block, to find where the data moved by an
+    insertion or a deletion matches again. To bound the time spent on files
+    which changed completely, within a run of blocks not found the window is
+    only rolled at the 1st, 2nd, 4th, 8th... of them.
+
+    Returns the sha256 digests of both files, the byte ranges of the post
+    file not found in the pre file and the percentage of the post file
+    they represent, and the number of bytes of the pre file not found in
+    the post file.
+    '''
+    block_size = _delta_block_size(os.stat(pre_file).st_size)
+    pre_digest = hashlib.sha256()
+    signatures = {}
+    pre_size = 0
+    with salt.utils.fopen(pre_file, 'rb') as pre_fd:
+        while True:
+            block = pre_fd.read(block_size)
+            if not block:
+                break
+            _COUNTERS['bytes_read'] += len(block)
+            if throttle:
+                throttle.read(len(block))
+            pre_digest.update(block)
+            signatures.setdefault(zlib.adler32(block) & 0xffffffff, {}).setdefault(
+                hashlib.md5(block).digest(), (pre_size, len(block)))
+            pre_size += len(block)
+
+    post_digest = hashlib.sha256()
+    changed = []
+    matched = set()
+    post_size = 0
+    buf = b''
+    pos = 0     # position of the window in buf
+    base = 0    # offset of buf in the post file
+    eof = False
+
+    def _match(window, checksum):
+        found = signatures.get(checksum)
+        return found.get(hashlib.md5(window).digest()) if found else None
+
+    def _mark(start, end):
+        if changed and changed[-1][1] == start:
+            changed[-1][1] = end
+        else:
+            changed.append([start, end])
+
+    with salt.utils.fopen(post_file, 'rb') as post_fd:
+        misses = 0
+        while True:
+            # Keep two blocks ahead of the window to be able to roll it
+            while not eof and len(buf) - pos < 2 * block_size:
+                chunk = post_fd.read(block_size)
+                if not chunk:
+                    eof = True
+                    break
+                _COUNTERS['bytes_read'] += len(chunk)
+                if throttle:
+                    throttle.read(len(chunk))
+                post_digest.update(chunk)
+                post_size += len(chunk)
+                buf = buf[pos:] + chunk
+                base += pos
+                pos = 0
+            window = buf[pos:pos + block_size]
+            if not window:
+                break
+
+            checksum = zlib.adler32(window) & 0xffffffff
+            found = _match(window, checksum)
+            if found is None and not misses & (misses - 1) and len(window) == block_size:
+                data = bytearray(buf)
+                for shift in range(1, min(block_size, len(data) - pos - block_size) + 1):
+                    checksum = _roll_adler32(checksum, data[pos + shift - 1],
+                                             data[pos + shift + block_size - 1], block_size)
+                    found = _match(buf[pos + shift:pos + shift + block_size], checksum)
+                    if found is not None:
+                        _mark(base + pos, base + pos + shift)
+                        pos += shift
+                        window = buf[pos:pos + block_size]
+                        break
+
+            if found is None:
+                _mark(base + pos, base + pos + len(window))
+                misses += 1
+            else:
+                matched.add(found)
+                misses = 0
+            pos += len(window)
+
+    bytes_changed = sum(end - start for start, end in changed)
+    ret = {'old_sha256_digest': pre_digest.hexdigest(),
+           'new_sha256_digest': post_digest.hexdigest(),
+           'block_size': block_size,
+           'bytes_changed': bytes_changed,
+           'bytes_removed': pre_size - sum(length for _, length in matched),
+           'percent_changed': round(100.0 * bytes_changed / post_size, 2) if post_size else 0.0,
+           'changed_ranges': changed[:DELTA_MAX_RANGES]}
+    if len(changed) > DELTA_MAX_RANGES:
+        ret['changed_ranges_truncated'] = True
+    return ret
+
+
+_HUNK_HEADER_RE = re.compile(r'^@@ -(\d+)(,\d+)? \+(\d+)(,\d+)? @@$')
+
+
+def _unified_diff(pre_lines, post_lines, fromfile, tofile, context=3, max_diff_lines=None):
+    '''
+    Returns a tuple (diff, added, removed, truncated) with the unified diff
+    between two lists of lines and the number of added and removed lines.
+
+    Leading and trailing lines common to both files are stripped before the
+    comparison, so difflib only has to match the region that changed. When
+    max_diff_lines is given the diff is cut after that many lines, but the
+    added and removed lines are still counted for the whole diff.
+    '''
+    limit = min(len(pre_lines), len(post_lines))
+    prefix = 0
+    while prefix < limit and pre_lines[prefix] == post_lines[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and pre_lines[-1 - suffix] == post_lines[-1 - suffix]:
+        suffix += 1
+
+    # Keep enough common lines around the changed region to fill the context
+    offset = max(prefix - context, 0)
+    tail = max(suffix - context, 0)
+    lines = difflib.unified_diff(pre_lines[offset:len(pre_lines) - tail],
+                                 post_lines[offset:len(post_lines) - tail],
+                                 fromfile=fromfile, tofile=tofile, n=context)
+
+    diff_lines = []
+    added = removed = 0
+    truncated = False
+    for index, line in enumerate(lines):
+        if line.startswith('@@'):
+            if offset:
+                line = _HUNK_HEADER_RE.sub(
+                    lambda m: '@@ -{0}{1} +{2}{3} @@'.format(
+                        int(m.group(1)) + offset, m.group(2) or '',
+                        int(m.group(3)) + offset, m.group(4) or ''),
+                    line.rstrip('\n')) + '\n'
+        elif index > 1:
+            if line.startswith('+'):
+                added += 1
+            elif line.startswith('-'):
+                removed += 1
+        if max_diff_lines is None or len(diff_lines) < max_diff_lines:
+            diff_lines.append(line)
+        else:
+            truncated = True
+    return ''.join(diff_lines), added, removed, truncated
+
+
 def _is_text_file(filename):
     '''
     Checks if a file is a text file
@@ -368,6 +1222,13 @@ def run(function, *args, **kwargs):
     cleanup_algorithm
         Snapper cleanup algorithm. (default: "number")
 
+    background_comparison
+        Compare the pre and post snapshots in a background thread once the
+        function returns, so later calls to ``snapper.status``,
+        ``snapper.diff_jid`` or ``snapper.undo_jid`` for this job find the
+        comparison already cached. (default: the
+        ``snapper.background_comparison`` minion option, or False)
+
     `*args`
         args for the function to call. (default: None)
 
@@ -388,6 +1249,8 @@ def run(function, *args, **kwargs):
     description = kwargs.pop("description", "snapper.run[{0}]".format(function))
     cleanup_algorithm = kwargs.pop("cleanup_algorithm", "number")
     userdata = kwargs.pop("userdata", {})
+    background_comparison = kwargs.pop(
+        "background_comparison", __opts__.get('snapper.background_comparison', False))
 
     func_kwargs = dict((k, v) for k, v in kwargs.items() if not k.startswith('__'))
     kwargs = dict((k, v) for k, v in kwargs.items() if k.startswith('__'))
@@ -410,7 +1273,7 @@ def run(function, *args, **kwargs):
     except CommandExecutionError as exc:
         ret = "\n".join([str(exc), __salt__[function].__doc__])
 
-    __salt__['snapper.create_snapshot'](
+    post_nr = __salt__['snapper.create_snapshot'](
         config=config,
         snapshot_type='post',
         pre_number=pre_nr,
@@ -418,10 +1281,54 @@ def run(function, *args, **kwargs):
         cleanup_algorithm=cleanup_algorithm,
         userdata=userdata,
         **kwargs)
+
+    if background_comparison:
+        # Not a daemon thread: the job process waits for the comparison to be
+        # stored before exiting, but the job return is not delayed by it.
+        threading.Thread(target=_background_comparison,
+                         name='snapper-comparison-{0}-{1}'.format(pre_nr, post_nr),
+                         args=(config, pre_nr, post_nr)).start()
+    return ret
+
+
+def _rollup(files, depth=None, threshold=None):
+    '''
+    Returns the status of the changed files, aggregating into per-directory
+    counts the files deeper than `depth` path components and the files of
+    directories with more than `threshold` changed entries.
+
+    Aggregated directories are returned as ``<directory>/*`` with the
+    number of files and the number of files for every status.
+    '''
+    ret = {}
+    by_dir = {}
+
+    def _count(key, bits):
+        entry = ret.setdefault(key, {'files': 0, 'status': {}})
+        entry['files'] += 1
+        for name in status_to_string(bits):
+            entry['status'][name] = entry['status'].get(name, 0) + 1
+
+    for path, bits in files.items():
+        parts = path.strip('/').split('/')
+        if depth is not None and len(parts) > depth:
+            _count('/'.join([''] + parts[:depth]) + '/*', bits)
+        elif threshold is not None:
+            by_dir.setdefault(os.path.dirname(path), []).append((path, bits))
+        else:
+            ret[path] = {'status': status_to_string(bits)}
+
+    for dirname, entries in by_dir.items():
+        for path, bits in entries:
+            if len(entries) > threshold:
+                _count(dirname.rstrip('/') + '/*', bits)
+            else:
+                ret[path] = {'status': status_to_string(bits)}
     return ret
 
 
-def status(config='root', num_pre=None, num_post=None):
+def status(config='root', num_pre=None, num_post=None, compact=False,
+           rollup_depth=None, rollup_threshold=None, path=None, timeout=None):
     '''
     Returns a comparison between two snapshots
 
@@ -434,20 +1341,69 @@ def status(config='root', num_pre=None, num_post=None):
     num_post
         last snapshot ID to compare. Default is 0 (current state)
 
+    compact
+        Return the files grouped by directory with their numeric status,
+        to be expanded on the master with the ``snapper.decode`` runner.
+        Default is False
+
+    rollup_depth
+        Aggregate the files deeper than this number of path components into
+        a ``<directory>/*`` entry with the number of files per status.
+
+    rollup_threshold
+        Aggregate the files of directories with more than this number of
+        changed entries into a ``<directory>/*`` entry.
+
+    path
+        Only return the changes under this path, to drill into a directory
+        aggregated by a previous call.
+
+    timeout
+        Seconds to wait for snapper to compare the snapshots. If the
+        comparison is not finished by then, no files are returned and the
+        return is flagged with ``incomplete``, holding the ``num_pre`` and
+        ``num_post`` to call again with. The comparison is abandoned; to have
+        comparisons ready in advance, use ``background_comparison`` with
+        :py:func:`snapper.run <salt.modules.snapper.run>`.
+        Default is None (wait until done)
+
     CLI example:
 
     .. code-block:: bash
 
         salt '*' snapper.status
         salt '*' snapper.status num_pre=19 num_post=20
+        salt '*' snapper.status compact=True
+        salt '*' snapper.status rollup_depth=3
+        salt '*' snapper.status path=/usr/lib/python3.4/site-packages rollup_threshold=100
+        salt '*' snapper.status timeout=60
     '''
+    if compact and (rollup_depth is not None or rollup_threshold is not None):
+        raise CommandExecutionError('The compact and rollup formats cannot be combined')
+
     try:
         pre, post = _get_num_interval(config, num_pre, num_post)
-        snapper.CreateComparison(config, int(pre), int(post))
-        files = snapper.GetFiles(config, int(pre), int(post))
-        status_ret = {}
-        for file in files:
-            status_ret[file[0]] = {'status': status_to_string(file[1])}
+        files = _get_files_status_until(config, pre, post, _Deadline(timeout))
+        incomplete = None
+        if files is None:
+            files = {}
+            incomplete = {'reason': 'timeout', 'num_pre': pre, 'num_post': post, 'cursor': None}
+        if path:
+            prefix = path.rstrip('/') + '/'
+            files = dict((file, file_status) for file, file_status in files.items()
+                         if file == path or file.startswith(prefix))
+        if rollup_depth is not None or rollup_threshold is not None:
+            status_ret = _rollup(files,
+                                 depth=int(rollup_depth) if rollup_depth is not None else None,
+                                 threshold=int(rollup_threshold) if rollup_threshold is not None else None)
+        elif compact:
+            status_ret = {'format': COMPACT_FORMAT, 'status': _group_by_dir(files)}
+        else:
+            status_ret = {}
+            for file, file_status in files.items():
+                status_ret[file] = {'status': status_to_string(file_status)}
+        if incomplete:
+            status_ret['incomplete'] = incomplete
         return status_ret
     except dbus.DBusException as exc:
         raise CommandExecutionError(
@@ -456,7 +1412,7 @@ def status(config='root', num_pre=None, num_post=None):
         )
 
 
-def changed_files(config='root', num_pre=None, num_post=None):
+def changed_files(config='root', num_pre=None, num_post=None, compact=False):
     '''
     Returns the files changed between two snapshots
 
@@ -469,6 +1425,10 @@ def changed_files(config='root', num_pre=None, num_post=None):
     num_post
         last snapshot ID to compare. Default is 0 (current state)
 
+    compact
+        Return the file names grouped by directory, to be expanded on the
+        master with the ``snapper.decode`` runner. Default is False
+
     CLI example:
 
     .. code-block:: bash
@@ -476,14 +1436,93 @@ def changed_files(config='root', num_pre=None, num_post=None):
         salt '*' snapper.changed_files
         salt '*' snapper.changed_files num_pre=19 num_post=20
     '''
+    if compact:
+        grouped = status(config, num_pre, num_post, compact=True)['status']
+        return {'format': COMPACT_FORMAT,
+                'files': dict((dirname, sorted(names)) for dirname, names in grouped.items())}
     return status(config, num_pre, num_post).keys()
 
 
-def undo(config='root', files=None, num_pre=None, num_post=None):
+def _undochange(pre, post, files, throttle=None):
+    '''
+    Runs ``snapper undochange`` for the given files and returns the number of
+    created, modified and deleted files
+
+    The files are restored in a single call: snapper only orders parent
+    directories and their contents within one call, and every call compares
+    the whole pre..post range again. Only the nice and ionice settings of
+    the throttle apply, the files are accounted without waiting.
+    '''
+    files = list(files)
+    cmd = 'snapper undochange {0}..{1} {2}'.format(pre, post, ' '.join(files))
+    cmdret = __salt__['cmd.run'](throttle.command(cmd) if throttle else cmd)
+    ret = {}
+    components = cmdret.split(' ')
+    for comp in components:
+        key, val = comp.split(':')
+        ret[key] = val
+    if throttle:
+        throttle.file(len(files), wait=False)
+    return ret
+
+
+def _shard_by_top_dir(files):
+    '''
+    Groups files by their top-level directory.
+
+    Every parent directory of a file shares its top-level directory, so
+    created or deleted directories always land in the same shard as their
+    contents and snapper keeps restoring parents before children.
+    '''
+    shards = {}
+    for path in files:
+        top = '/' + path.lstrip('/').split('/', 1)[0]
+        shards.setdefault(top, []).append(path)
+    return shards
+
+
+def _pack_shards(shards, workers):
+    '''
+    Packs the top-level directory shards into at most `workers` groups of
+    similar size, biggest shards first. Returns a dict with the
+    comma-separated top-level directories of every group as key and their
+    files as value.
+    '''
+    heap = [(0, index, []) for index in range(workers)]
+    for top in sorted(shards, key=lambda x: (-len(shards[x]), x)):
+        size, index, tops = heapq.heappop(heap)
+        tops.append(top)
+        heapq.heappush(heap, (size + len(shards[top]), index, tops))
+    groups = {}
+    for _, _, tops in heap:
+        if tops:
+            groups[','.join(sorted(tops))] = [path for top in tops for path in shards[top]]
+    return groups
+
+
+def undo(config='root', files=None, num_pre=None, num_post=None, workers=1,
+         throttle=None):
     '''
     Undo all file changes that happened between num_pre and num_post, leaving
     the files into the state of num_pre.
 
+    workers
+        Number of ``snapper undochange`` processes to run at the same time.
+        With more than one worker the files are split by their top-level
+        directory into at most that many groups, and the return includes the
+        result and timing of every group under ``shards``. Every worker makes
+        snapperd compare the whole num_pre..num_post range again, which is a
+        walk of the live filesystem with num_post=0, so only use more than one
+        worker when restoring the files costs more than comparing them.
+        Default is 1
+
+    throttle
+        Dict with the ``nice`` and ``ionice`` settings for the ``snapper
+        undochange`` processes, merged over the ``snapper.throttle`` minion
+        option. ``files_per_second`` is not applied, the files are restored
+        in one call so snapper can order directories and their contents.
+        The achieved throughput is returned under ``throttle``.
+
     .. warning::
         If one of the files has changes after num_post, they will be overwriten
         The snapshots are used to determine the file list, but the current
@@ -503,13 +1542,35 @@ def undo(config='root', files=None, num_pre=None, num_post=None):
             'Given file list contains files that are not present'
             'in the changed filelist: {0}'.format(changed - requested))
 
-    cmdret = __salt__['cmd.run']('snapper undochange {0}..{1} {2}'.format(
-        pre, post, ' '.join(requested)))
-    components = cmdret.split(' ')
-    ret = {}
-    for comp in components:
-        key, val = comp.split(':')
-        ret[key] = val
+    throttle = _get_throttle(throttle)
+    shards = _shard_by_top_dir(requested)
+    workers = min(int(workers), len(shards))
+    if workers <= 1:
+        ret = _undochange(pre, post, requested, throttle)
+        if throttle:
+            ret['throttle'] = throttle.report()
+        return ret
+    shards = _pack_shards(shards, workers)
+
+    def _undo_shard(shard):
+        start = time.time()
+        shard_ret = _undochange(pre, post, shards[shard], throttle)
+        shard_ret.update({'files': len(shards[shard]),
+                          'time': round(time.time() - start, 3)})
+        return shard, shard_ret
+
+    pool = ThreadPool(workers)
+    try:
+        results = pool.map(_undo_shard, sorted(shards))
+    finally:
+        pool.close()
+        pool.join()
+
+    ret = {'shards': dict(results)}
+    for key in ('create', 'modify', 'delete'):
+        ret[key] = str(sum(int(shard_ret.get(key, 0)) for _, shard_ret in results))
+    if throttle:
+        ret['throttle'] = throttle.report()
     return ret
 
 
@@ -520,20 +1581,20 @@ def _get_jid_snapshots(jid, config='root'):
     Looks for 'salt_jid' entries into snapshots userdata which are created
     when 'snapper.run' is executed.
     '''
-    jid_snapshots = [x for x in list_snapshots(config) if x['userdata'].get("salt_jid") == jid]
-    pre_snapshot = [x for x in jid_snapshots if x['type'] == "pre"]
-    post_snapshot = [x for x in jid_snapshots if x['type'] == "post"]
+    jid_snapshots = _list_snapshots(config, userdata={'salt_jid': jid})
+    pre_snapshot = [x for x in jid_snapshots if x.type == "pre"]
+    post_snapshot = [x for x in jid_snapshots if x.type == "post"]
 
     if not pre_snapshot or not post_snapshot:
         raise CommandExecutionError("Jid '{0}' snapshots not found".format(jid))
 
     return (
-        pre_snapshot[0]['id'],
-        post_snapshot[0]['id']
+        pre_snapshot[0].id,
+        post_snapshot[0].id
     )
 
 
-def undo_jid(jid, config='root'):
+def undo_jid(jid, config='root', workers=1, throttle=None):
     '''
     Undo the changes applied by a salt job
 
@@ -543,6 +1604,9 @@ def undo_jid(jid, config='root'):
     config
         Configuration name.
 
+    workers, throttle
+        See :py:func:`snapper.undo <salt.modules.snapper.undo>`
+
     CLI example:
 
     .. code-block:: bash
@@ -550,10 +1614,379 @@ def undo_jid(jid, config='root'):
         salt '*' snapper.undo_jid jid=20160607130930720112
     '''
     pre_snapshot, post_snapshot = _get_jid_snapshots(jid, config=config)
-    return undo(config, num_pre=pre_snapshot, num_post=post_snapshot)
+    return undo(config, num_pre=pre_snapshot, num_post=post_snapshot, workers=workers,
+                throttle=throttle)
+
+
+def _get_jids_snapshots(jids, config='root'):
+    '''
+    Returns a dict mapping every jid to its pre/post snapshots, listing the
+    snapshots only once
+    '''
+    pairs = dict((jid, [None, None]) for jid in jids)
+    for snapshot in _list_snapshots(config):
+        jid = snapshot.userdata.get('salt_jid')
+        if jid in pairs and snapshot.type in ('pre', 'post'):
+            index = 0 if snapshot.type == 'pre' else 1
+            if pairs[jid][index] is None:
+                pairs[jid][index] = snapshot.id
+
+    missing = sorted(jid for jid, pair in pairs.items() if None in pair)
+    if missing:
+        raise CommandExecutionError("Jid '{0}' snapshots not found".format("', '".join(missing)))
+    return dict((jid, tuple(pair)) for jid, pair in pairs.items())
 
 
-def diff(config='root', filename=None, num_pre=None, num_post=None):
+def undo_jids(jids, config='root', throttle=None):
+    '''
+    Undo the changes applied by several salt jobs at once
+
+    jids
+        List of job ids, or a comma separated string of them
+
+    config
+        Configuration name.
+
+    throttle
+        See :py:func:`snapper.undo <salt.modules.snapper.undo>`
+
+    Every changed file is restored only once, to its state before the first
+    of the jobs that changed it. The restores run starting with the newest
+    jobs. Files whose changes cancel out across the
+    jobs are left untouched and listed under ``unchanged``. The files changed
+    by every job are listed under ``jids`` and every ``snapper undochange``
+    run under ``restores``.
+
+    CLI example:
+
+    .. code-block:: bash
+
+        salt '*' snapper.undo_jids jids=20160607130930720112,20160607131130721455
+    '''
+    if not isinstance(jids, (list, tuple)):
+        jids = [jid.strip() for jid in str(jids).split(',') if jid.strip()]
+    jids = [str(jid) for jid in jids]
+    throttle = _get_throttle(throttle)
+    pairs = _get_jids_snapshots(jids, config=config)
+
+    try:
+
+        # The first pre and the last post snapshot of the jobs changing every file
+        ranges = {}
+        ret = {'jids': {}, 'restores': [], 'unchanged': []}
+        for jid in jids:
+            pre, post = pairs[jid]
+            files = sorted(_get_files_status(config, pre, post))
+            ret['jids'][jid] = {'pre': pre, 'post': post, 'files': files}
+            for file in files:
+                first, last = ranges.get(file, (pre, post))
+                ranges[file] = (min(first, pre), max(last, post))
+
+        groups = {}
+        for file, pair in ranges.items():
+            groups.setdefault(pair, []).append(file)
+
+        # Newest jobs first, so a directory created by a job is emptied by
+        # undoing the later jobs before it is removed, and a deleted one is
+        # recreated before the files restored into it
+        for pre, post in sorted(groups, key=lambda pair: (pair[1], pair[0]), reverse=True):
+            changed = _get_files_status(config, pre, post)
+            files = sorted(file for file in groups[(pre, post)] if file in changed)
+            ret['unchanged'].extend(file for file in groups[(pre, post)] if file not in changed)
+            if not files:
+                continue
+            restore = _undochange(pre, post, files, throttle)
+            restore.update({'pre': pre, 'post': post, 'files': len(files)})
+            ret['restores'].append(restore)
+    except dbus.DBusException as exc:
+        raise CommandExecutionError(
+            'Error encountered while undoing jobs {0}: {1}'
+            .format(', '.join(jids), _dbus_exception_to_reason(exc, locals()))
+        )
+
+    ret['unchanged'].sort()
+    for key in ('create', 'modify', 'delete'):
+        ret[key] = str(sum(int(restore.get(key, 0)) for restore in ret['restores']))
+    if throttle:
+        ret['throttle'] = throttle.report()
+    return ret
+
+
+def _get_cache_dir(name):
+    '''
+    Returns the directory of the minion cachedir where the snapper module
+    keeps the `name` cache, or None if there is no cachedir available
+    '''
+    cachedir = __opts__.get('cachedir')
+    if not cachedir:
+        return None
+    path = os.path.join(cachedir, 'snapper', name)
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                log.warning('Unable to create snapper cache directory %s', path)
+                return None
+    return path
+
+
+def _cache_write(path, data):
+    '''
+    Atomically writes `data` as JSON into `path`
+    '''
+    fd_, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.')
+    try:
+        with os.fdopen(fd_, 'w') as cache_file:
+            json.dump(data, cache_file)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def _cache_evict(cache_dir, max_size):
+    '''
+    Removes the least recently used entries of a cache directory until
+    it is not bigger than `max_size` bytes
+    '''
+    entries = []
+    for path in glob.glob(os.path.join(cache_dir, '*.json')):
+        try:
+            file_stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((file_stat.st_mtime, file_stat.st_size, path))
+    total = sum(entry[1] for entry in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+def _cache_invalidate(config, numbers):
+    '''
+    Removes the cached listing and every cached diff and comparison involving
+    one of the given snapshot numbers
+    '''
+    _listing_invalidate(config)
+    numbers = set(int(number) for number in numbers)
+    for name in ('diff', 'comparison'):
+        cache_dir = _get_cache_dir(name)
+        if not cache_dir:
+            continue
+        for path in glob.glob(os.path.join(cache_dir, '{0}.*.json'.format(config))):
+            try:
+                pre, post = os.path.basename(path)[len(config) + 1:].split('.')[:2]
+                if int(pre) in numbers or int(post) in numbers:
+                    os.remove(path)
+            except (OSError, ValueError):
+                continue
+    for number in numbers:
+        path = _manifest_path(config, number)
+        if path and os.path.exists(path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _snapshots_version(subvolume):
+    '''
+    Returns the version of the snapshots of a configuration as found in its
+    .snapshots directory: the newest snapshot number, the number of
+    snapshots and the modification times of the directory and of the
+    description of the newest snapshot. None if it cannot be read.
+    '''
+    path = os.path.join(subvolume, '.snapshots')
+    try:
+        numbers = [int(name) for name in os.listdir(path) if name.isdigit()]
+        newest = max(numbers) if numbers else 0
+        info_mtime = os.stat(os.path.join(path, str(newest), 'info.xml')).st_mtime if numbers else None
+        return [newest, len(numbers), os.stat(path).st_mtime, info_mtime]
+    except OSError:
+        return None
+
+
+def _listing_path(config):
+    '''
+    Returns the cache file of the snapshot listing of a configuration, or
+    None if the listing cache is disabled
+    '''
+    if float(__opts__.get('snapper.listing_cache_ttl', LISTING_CACHE_TTL)) <= 0:
+        return None
+    cache_dir = _get_cache_dir('listing')
+    return os.path.join(cache_dir, '{0}.json'.format(config)) if cache_dir else None
+
+
+def _get_snapshots(config):
+    '''
+    Returns the snapshots of a configuration as listed by snapper.
+
+    Every job runs in its own process, so the listing is shared between jobs
+    in the minion cachedir. It is only requested again to snapper when the
+    version of the snapshots changed or the cached listing is older than the
+    ``snapper.listing_cache_ttl`` minion option. The version is taken before
+    listing, so a snapshot created meanwhile makes the next job list again.
+    '''
+    path = _listing_path(config)
+    if path:
+        try:
+            with salt.utils.fopen(path) as cache_file:
+                cached = json.load(cache_file)
+            ttl = float(__opts__.get('snapper.listing_cache_ttl', LISTING_CACHE_TTL))
+            if time.time() - cached['time'] < ttl and \
+                    _snapshots_version(cached['subvolume']) == cached['version']:
+                return cached['snapshots']
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+
+    subvolume = _get_config(config)[1] if path else None
+    version = _snapshots_version(subvolume) if path else None
+    start = time.time()
+    snapshots = snapper.ListSnapshots(config)
+    if version is not None:
+        try:
+            _cache_write(path, {'version': version, 'subvolume': subvolume,
+                                'time': start, 'snapshots': snapshots})
+        except (IOError, OSError, TypeError, ValueError) as exc:
+            log.debug('Unable to cache the snapshots of %s: %s', config, exc)
+    return snapshots
+
+
+def _get_timestamp(config, number):
+    '''
+    Returns the timestamp of a snapshot, from the shared listing if cached
+    '''
+    if _listing_path(config):
+        for snapshot in _get_snapshots(config):
+            if snapshot[0] == number:
+                return snapshot[3]
+    return snapper.GetSnapshot(config, number)[3]
+
+
+def _listing_invalidate(config):
+    '''
+    Removes the cached snapshot listing of a configuration
+    '''
+    path = _listing_path(config)
+    if path and os.path.exists(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _comparison_path(config, pre, post):
+    '''
+    Returns the cache file of the comparison between two snapshots, or None
+    if the comparison cache is disabled
+    '''
+    if int(__opts__.get('snapper.comparison_cache_size', COMPARISON_CACHE_SIZE)) <= 0:
+        return None
+    cache_dir = _get_cache_dir('comparison')
+    if not cache_dir:
+        return None
+    return os.path.join(cache_dir, '{0}.{1}.{2}.json'.format(config, int(pre), int(post)))
+
+
+def _load_comparison(config, pre, post, timestamps):
+    '''
+    Returns the cached status bitmasks of the files changed between two
+    snapshots, or None if the comparison is not cached
+    '''
+    path = _comparison_path(config, pre, post)
+    if not path:
+        return None
+    try:
+        with salt.utils.fopen(path, 'r') as cache_file:
+            data = json.load(cache_file)
+        os.utime(path, None)
+    except (IOError, OSError, ValueError):
+        return None
+    # A different timestamp means the snapshot number has been reused
+    if data.get('timestamps') != list(timestamps):
+        return None
+    return data['files']
+
+
+def _save_comparison(config, pre, post, timestamps, files):
+    '''
+    Stores the status bitmasks of the files changed between two snapshots
+    '''
+    path = _comparison_path(config, pre, post)
+    if not path:
+        return
+    try:
+        _cache_write(path, {'timestamps': list(timestamps), 'files': files})
+    except (IOError, OSError, TypeError, ValueError) as exc:
+        log.warning('Unable to cache snapper comparison %s..%s: %s', pre, post, exc)
+        return
+    _cache_evict(os.path.dirname(path),
+                 int(__opts__.get('snapper.comparison_cache_size', COMPARISON_CACHE_SIZE)))
+
+
+def _diff_cache_key(config, pre, post, **options):
+    '''
+    Returns the cache file name for a diff between two snapshots, or None
+    if the diff cache is disabled.
+
+    The snapshot timestamps are part of the key, so a snapshot number
+    reused after deleting the previous snapshot never hits stale data.
+    '''
+    if int(__opts__.get('snapper.diff_cache_size', DIFF_CACHE_SIZE)) <= 0 or \
+            not _get_cache_dir('diff'):
+        return None
+    key = [DIFF_CACHE_VERSION, config, pre, _get_timestamp(config, pre),
+           post, _get_timestamp(config, post),
+           sorted(options.items())]
+    digest = hashlib.sha256(json.dumps(key).encode('utf-8')).hexdigest()
+    return '{0}.{1}.{2}.{3}.json'.format(config, pre, post, digest)
+
+
+def _diff_cache_get(key):
+    '''
+    Returns the cached diff stored under `key`, or None if it is not cached
+    '''
+    cache_dir = _get_cache_dir('diff')
+    if not cache_dir:
+        return None
+    path = os.path.join(cache_dir, key)
+    try:
+        with salt.utils.fopen(path, 'r') as cache_file:
+            data = json.load(cache_file)
+        # The modification time tracks the last use for the LRU eviction
+        os.utime(path, None)
+        return data
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _diff_cache_set(key, data):
+    '''
+    Stores a diff under `key` and evicts the least recently used entries
+    once the cache grows over its size limit
+    '''
+    max_size = int(__opts__.get('snapper.diff_cache_size', DIFF_CACHE_SIZE))
+    cache_dir = _get_cache_dir('diff')
+    if not cache_dir or max_size <= 0:
+        return
+    try:
+        _cache_write(os.path.join(cache_dir, key), data)
+    except (IOError, OSError, TypeError, ValueError) as exc:
+        log.warning('Unable to cache snapper diff %s: %s', key, exc)
+        return
+
+    _cache_evict(cache_dir, max_size)
+
+
+def diff(config='root', filename=None, num_pre=None, num_post=None,
+         context=3, max_diff_lines=None, summary_only=False, compact=False,
+         throttle=None, timeout=None, cursor=None):
     '''
     Returns the differences between two snapshots
 
@@ -570,72 +2003,173 @@ def diff(config='root', filename=None, num_pre=None, num_post=None):
     num_post
         last snapshot ID to compare. Default is 0 (current state)
 
+    context
+        Number of context lines in the text diffs. Default is 3
+
+    max_diff_lines
+        Maximum number of lines returned for every text diff. Longer diffs
+        are truncated and flagged with ``diff_truncated``, together with the
+        exact number of ``lines_added`` and ``lines_removed``.
+        Default is None (no limit)
+
+    summary_only
+        Only return the number of added and removed lines of the text
+        files instead of the diffs. Default is False
+
+    compact
+        Return the files grouped by directory with zlib compressed diffs,
+        to be expanded on the master with the ``snapper.decode`` runner.
+        Default is False
+
+    throttle
+        Dict with the ``nice``, ``ionice``, ``bytes_per_second`` and
+        ``files_per_second`` limits used while comparing the files, merged
+        over the ``snapper.throttle`` minion option. The achieved throughput
+        is returned under ``throttle``. The ``nice`` and ``ionice`` settings
+        lower the priority of the job process, which is kept for the rest of
+        the job, including the states run after this one in a highstate.
+
+    timeout
+        Seconds after which no more files are compared. The files compared
+        until then are returned and the return is flagged with
+        ``incomplete``, holding the ``num_pre``, ``num_post`` and ``cursor``
+        to call again with to get the remaining files. A comparison of the
+        snapshots still running at the deadline is abandoned, as in
+        :py:func:`snapper.status <salt.modules.snapper.status>`.
+        Default is None (compare every file)
+
+    cursor
+        Only compare the files sorting after this path, as returned in
+        ``incomplete`` by a call that timed out.
+
+    Diffs between two existing snapshots never change, so they are cached
+    in the minion cachedir. The size of the cache is limited by the
+    ``snapper.diff_cache_size`` minion option (in bytes, 0 disables it).
+
     CLI example:
 
     .. code-block:: bash
 
         salt '*' snapper.diff
         salt '*' snapper.diff filename=/var/log/snapper.log num_pre=19 num_post=20
+        salt '*' snapper.diff max_diff_lines=500 context=1
+        salt '*' snapper.diff timeout=240
     '''
     try:
         pre, post = _get_num_interval(config, num_pre, num_post)
 
-        files = changed_files(config, pre, post)
+        if summary_only:
+            max_diff_lines = 0
+        elif max_diff_lines is not None:
+            max_diff_lines = int(max_diff_lines)
+
+        cache_key = None
+        if pre and post and cursor is None:
+            cache_key = _diff_cache_key(config, int(pre), int(post), filename=filename,
+                                        context=int(context),
+                                        max_diff_lines=max_diff_lines,
+                                        summary_only=bool(summary_only))
+            cached = _diff_cache_get(cache_key) if cache_key else None
+            if cached is not None:
+                return _compact_diff(cached) if compact else cached
+
+        throttle = _get_throttle(throttle)
+        if throttle:
+            throttle.renice()
+
+        deadline = _Deadline(timeout)
+        incomplete = None
+        files = _get_files_status_until(config, pre, post, deadline)
+        if files is None:
+            files = {}
+            incomplete = {'reason': 'timeout', 'cursor': cursor}
         if filename:
-            files = [filename] if filename in files else []
+            files = {filename: files[filename]} if filename in files else {}
 
-        pre_mount = snapper.MountSnapshot(config, pre, False) if pre else ""
-        post_mount = snapper.MountSnapshot(config, post, False) if post else ""
+        pre_mount = _mount_snapshot(config, pre)
+        post_mount = _mount_snapshot(config, post)
+        live_mount = _mount_snapshot(config, 0)
 
         files_diff = dict()
-        for filepath in [filepath for filepath in files if not os.path.isdir(filepath)]:
-            pre_file = pre_mount + filepath
-            post_file = post_mount + filepath
-
-            if os.path.isfile(pre_file):
-                pre_file_exists = True
-                pre_file_content = salt.utils.fopen(pre_file).readlines()
-            else:
-                pre_file_content = []
-                pre_file_exists = False
-
-            if os.path.isfile(post_file):
-                post_file_exists = True
-                post_file_content = salt.utils.fopen(post_file).readlines()
-            else:
-                post_file_content = []
-                post_file_exists = False
-
-            if _is_text_file(pre_file) or _is_text_file(post_file):
-                files_diff[filepath] = {
-                    'comment': "text file changed",
-                    'diff': ''.join(difflib.unified_diff(pre_file_content,
-                                                         post_file_content,
-                                                         fromfile=pre_file,
-                                                         tofile=post_file))}
-
-                if pre_file_exists and not post_file_exists:
-                    files_diff[filepath]['comment'] = "text file deleted"
-                if not pre_file_exists and post_file_exists:
-                    files_diff[filepath]['comment'] = "text file created"
-
-            elif not _is_text_file(pre_file) and not _is_text_file(post_file):
-                # This is a binary file
-                files_diff[filepath] = {'comment': "binary file changed"}
-                if pre_file_exists:
-                    files_diff[filepath]['old_sha256_digest'] = __salt__['hashutil.sha256_digest'](''.join(pre_file_content))
-                if post_file_exists:
-                    files_diff[filepath]['new_sha256_digest'] = __salt__['hashutil.sha256_digest'](''.join(post_file_content))
-                if post_file_exists and not pre_file_exists:
-                    files_diff[filepath]['comment'] = "binary file created"
-                if pre_file_exists and not post_file_exists:
-                    files_diff[filepath]['comment'] = "binary file deleted"
-
-        if pre:
-            snapper.UmountSnapshot(config, pre, False)
-        if post:
-            snapper.UmountSnapshot(config, post, False)
-        return files_diff
+        try:
+            for filepath in sorted(files):
+                if cursor is not None and filepath <= cursor:
+                    continue
+                if os.path.isdir(live_mount + filepath):
+                    continue
+                if deadline.expired():
+                    incomplete = {'reason': 'timeout', 'cursor': cursor}
+                    break
+                cursor = filepath
+
+                # Permission, owner, xattrs or ACL changes leave the content untouched
+                if not files[filepath] & DBUS_STATUS_CONTENT_MASK:
+                    files_diff[filepath] = {'comment': "file metadata changed"}
+                    continue
+
+                pre_file = pre_mount + filepath
+                post_file = post_mount + filepath
+                if throttle:
+                    throttle.file()
+
+                pre_file_exists = os.path.isfile(pre_file)
+                post_file_exists = os.path.isfile(post_file)
+
+                # Snapper may flag a file as modified while its content is the same
+                if (files[filepath] & DBUS_STATUS_CONTENT_MASK) == 8 and pre_file_exists and \
+                        post_file_exists and _same_content(pre_file, post_file, throttle):
+                    files_diff[filepath] = {'comment': "file metadata changed"}
+                    continue
+
+                pre_is_text = _is_text_file(pre_file)
+                post_is_text = _is_text_file(post_file)
+
+                if pre_is_text or post_is_text:
+                    pre_file_content = _read_lines(pre_file, throttle) if pre_file_exists else []
+                    post_file_content = _read_lines(post_file, throttle) if post_file_exists else []
+                    file_diff, added, removed, truncated = _unified_diff(
+                        pre_file_content, post_file_content, pre_file, post_file,
+                        context=int(context),
+                        max_diff_lines=max_diff_lines)
+                    files_diff[filepath] = {'comment': "text file changed"}
+                    if summary_only or truncated:
+                        files_diff[filepath].update({'lines_added': added,
+                                                     'lines_removed': removed})
+                    if not summary_only:
+                        files_diff[filepath]['diff'] = file_diff
+                        if truncated:
+                            files_diff[filepath]['diff_truncated'] = True
+
+                    if pre_file_exists and not post_file_exists:
+                        files_diff[filepath]['comment'] = "text file deleted"
+                    if not pre_file_exists and post_file_exists:
+                        files_diff[filepath]['comment'] = "text file created"
+
+                else:
+                    # This is a binary file
+                    files_diff[filepath] = {'comment': "binary file changed"}
+                    if pre_file_exists and post_file_exists:
+                        files_diff[filepath].update(_binary_delta(pre_file, post_file, throttle))
+                    if post_file_exists and not pre_file_exists:
+                        files_diff[filepath]['comment'] = "binary file created"
+                        files_diff[filepath]['new_sha256_digest'] = _file_digest(post_file, throttle)
+                    if pre_file_exists and not post_file_exists:
+                        files_diff[filepath]['comment'] = "binary file deleted"
+                        files_diff[filepath]['old_sha256_digest'] = _file_digest(pre_file, throttle)
+        finally:
+            _umount_snapshot(config, pre)
+            _umount_snapshot(config, post)
+
+        if incomplete:
+            incomplete.update({'num_pre': pre, 'num_post': post})
+        elif cache_key:
+            _diff_cache_set(cache_key, files_diff)
+        ret = _compact_diff(files_diff) if compact else files_diff
+        if throttle:
+            ret['throttle'] = throttle.report()
+        if incomplete:
+            ret['incomplete'] = incomplete
+        return ret
     except dbus.DBusException as exc:
         raise CommandExecutionError(
             'Error encountered while showing differences between snapshots: {0}'
@@ -643,7 +2177,8 @@ def diff(config='root', filename=None, num_pre=None, num_post=None):
         )
 
 
-def diff_jid(jid, config='root'):
+def diff_jid(jid, config='root', context=3, max_diff_lines=None, summary_only=False,
+             compact=False, throttle=None, timeout=None, cursor=None):
     '''
     Returns the changes applied by a `jid`
 
@@ -653,6 +2188,9 @@ def diff_jid(jid, config='root'):
     config
         Configuration name.
 
+    context, max_diff_lines, summary_only, compact, throttle, timeout, cursor
+        Passed to :py:func:`snapper.diff <salt.modules.snapper.diff>`
+
     CLI example:
 
     .. code-block:: bash
@@ -660,10 +2198,508 @@ def diff_jid(jid, config='root'):
         salt '*' snapper.diff_jid jid=20160607130930720112
     '''
     pre_snapshot, post_snapshot = _get_jid_snapshots(jid, config=config)
-    return diff(config, num_pre=pre_snapshot, num_post=post_snapshot)
+    return diff(config, num_pre=pre_snapshot, num_post=post_snapshot,
+                context=context, max_diff_lines=max_diff_lines,
+                summary_only=summary_only, compact=compact, throttle=throttle,
+                timeout=timeout, cursor=cursor)
+
+
+def _find_changes(config, path, numbers, changes, exact=False):
+    '''
+    Appends to `changes` the (pre, post, status) of every pair of consecutive
+    snapshots in `numbers` between which `path` changed.
+
+    The first and last snapshots are compared first, and the range is only
+    split in halves when the path changed between them, so the number of
+    comparisons grows with the number of changes of the path and not with
+    the number of snapshots. A range whose first and last snapshots have the
+    same file is skipped, even if the file changed and was restored in the
+    snapshots between them. With `exact`, every pair of consecutive
+    snapshots is compared instead. Comparisons between existing snapshots are
+    served from the comparison cache when available.
+    '''
+    if exact:
+        for pre, post in zip(numbers, numbers[1:]):
+            file_status = _get_files_status(config, pre, post).get(path)
+            if file_status:
+                changes.append((pre, post, file_status))
+        return
+    if len(numbers) < 2:
+        return
+    file_status = _get_files_status(config, numbers[0], numbers[-1]).get(path)
+    if not file_status:
+        return
+    if len(numbers) == 2:
+        changes.append((numbers[0], numbers[1], file_status))
+        return
+    middle = len(numbers) // 2
+    _find_changes(config, path, numbers[:middle + 1], changes)
+    _find_changes(config, path, numbers[middle:], changes)
+
+
+def _version(config, path, number):
+    '''
+    Returns the sha256 digest of a path in a snapshot
+    '''
+    mount = _mount_snapshot(config, number)
+    try:
+        return _file_digest(mount + path)
+    finally:
+        _umount_snapshot(config, number)
+
+
+def file_history(path, config='root', num_pre=None, num_post=0, diffs=False, context=3,
+                 exact=False):
+    '''
+    Returns the snapshots in which a file changed
+
+    path
+        Absolute path of the file
+
+    config
+        Configuration name.
+
+    num_pre
+        First snapshot ID of the range. Default is the oldest snapshot
+
+    num_post
+        Last snapshot ID of the range. Default is 0 (current state)
+
+    diffs
+        Include the diff of every change, as returned by
+        :py:func:`snapper.diff <salt.modules.snapper.diff>`. Default is False
+
+    context
+        Number of context lines in the text diffs. Default is 3
+
+    exact
+        Compare every pair of consecutive snapshots of the range, to find
+        the changes that were reverted later too. Default is False
 
+    By default the snapshots of the range are compared by halves, skipping
+    the parts of the range where the file did not change, so a long range
+    with few changes only needs a few comparisons. A part of the range is
+    skipped when the file is the same in its first and last snapshots, so a
+    change reverted later in the range (like a file edited in snapshot 2 and
+    restored in snapshot 3 of the range 1..3) is not reported, even with
+    snapshots in between. Use ``exact=True`` to find those too.
 
-def create_baseline(tag="baseline", config='root'):
+    The first version is the file in ``num_pre``, followed by one version
+    for every snapshot where the file changed, with the snapshot before it
+    as ``pre``, the ``status`` of the change and the ``sha256_digest`` of
+    the file (None if it did not exist or is not a regular file).
+
+    CLI example:
+
+    .. code-block:: bash
+
+        salt '*' snapper.file_history /etc/sudoers
+        salt '*' snapper.file_history /etc/sudoers num_pre=20 num_post=40 diffs=True
+        salt '*' snapper.file_history /etc/sudoers exact=True
+    '''
+    post = int(num_post) if num_post else 0
+    snapshots = _list_snapshots(config, min_id=int(num_pre) if num_pre is not None else None,
+                                max_id=post or None)
+    snapshots = dict((snapshot.id, snapshot) for snapshot in snapshots if snapshot.id)
+    if num_pre is not None and int(num_pre) not in snapshots:
+        raise CommandExecutionError('Snapshot {0} does not exist'.format(num_pre))
+    numbers = sorted(snapshots)
+    if not post:
+        numbers.append(0)
+
+    try:
+        changes = []
+        _find_changes(config, path, numbers, changes, exact=exact)
+
+        def _describe(number):
+            if not number:
+                return {'snapshot': 0, 'timestamp': int(time.time()),
+                        'description': 'current'}
+            return {'snapshot': number, 'timestamp': snapshots[number].timestamp,
+                    'description': snapshots[number].description}
+
+        versions = [_describe(numbers[0])]
+        versions[0]['sha256_digest'] = _version(config, path, numbers[0])
+        for pre, number, file_status in changes:
+            version = _describe(number)
+            version.update({'pre': pre,
+                            'status': status_to_string(file_status),
+                            'sha256_digest': _version(config, path, number)})
+            if diffs:
+                version.update(diff(config, filename=path, num_pre=pre, num_post=number,
+                                    context=context).get(path, {}))
+            versions.append(version)
+        return {'path': path, 'versions': versions}
+    except dbus.DBusException as exc:
+        raise CommandExecutionError(
+            'Error encountered while looking up the history of {0}: {1}'
+            .format(path, _dbus_exception_to_reason(exc, locals()))
+        )
+
+
+def _get_used_space(config, numbers):
+    '''
+    Returns the space in bytes exclusively used by every snapshot, or None
+    for all of them if snapper cannot calculate it (it needs btrfs quota
+    groups and a snapper version supporting it)
+    '''
+    try:
+        snapper.CalculateUsedSpace(config)
+        return dict((number, int(snapper.GetUsedSpace(config, number))) for number in numbers)
+    except dbus.DBusException as exc:
+        log.debug('Unable to calculate the space used by snapshots: %s', exc)
+        return dict((number, None) for number in numbers)
+
+
+def prune(config='root', keep_jids=None, keep_baselines=None, drop_empty=False,
+          max_age=None, space_budget=None, test=False):
+    '''
+    Deletes the snapshots created by Salt according to the given policies.
+
+    Only snapshots with a ``salt_jid`` (created by ``snapper.run``) or a
+    ``baseline_tag`` (created by ``snapper.create_baseline``) in their
+    userdata are considered, and the snapshots of a job are always deleted
+    together. All the snapshots are deleted with a single request to snapper.
+
+    config
+        Configuration name.
+
+    keep_jids
+        Keep the snapshots of the last N jobs only.
+
+    keep_baselines
+        Keep the last N baseline snapshots of every tag only.
+
+    drop_empty
+        Delete the pre and post snapshots of jobs which did not change any
+        file. Default is False
+
+    max_age
+        Delete the snapshots of jobs older than this number of seconds.
+
+    space_budget
+        Delete the snapshots of the oldest jobs until the space used by the
+        job snapshots is below this number of bytes. Needs btrfs quota groups.
+
+    test
+        Only report the snapshots that would be deleted. Default is False
+
+    Returns the deleted snapshots with the policy that matched them and
+    the space they used, if known.
+
+    CLI example:
+
+    .. code-block:: bash
+
+        salt '*' snapper.prune keep_jids=10 keep_baselines=2 drop_empty=True
+        salt '*' snapper.prune max_age=604800 test=True
+    '''
+    start = time.time()
+    jobs = {}
+    baselines = {}
+    for snapshot in _list_snapshots(config):
+        if 'baseline_tag' in snapshot.userdata:
+            baselines.setdefault(snapshot.userdata['baseline_tag'], []).append(snapshot)
+        elif 'salt_jid' in snapshot.userdata:
+            jobs.setdefault(snapshot.userdata['salt_jid'], []).append(snapshot)
+
+    # Newest jobs first
+    jids = sorted(jobs, key=lambda jid: max(s.id for s in jobs[jid]), reverse=True)
+    reasons = {}
+
+    def _drop(snapshots, reason):
+        for snapshot in snapshots:
+            reasons.setdefault(snapshot.id, reason)
+
+    if keep_jids is not None:
+        for jid in jids[int(keep_jids):]:
+            _drop(jobs[jid], 'keep_jids')
+
+    if max_age is not None:
+        cutoff = time.time() - int(max_age)
+        for jid in jids:
+            if max(s.timestamp for s in jobs[jid]) < cutoff:
+                _drop(jobs[jid], 'max_age')
+
+    if drop_empty:
+        for jid in jids:
+            pre = [s.id for s in jobs[jid] if s.type == 'pre']
+            post = [s.id for s in jobs[jid] if s.type == 'post']
+            if pre and post and not _get_files_status(config, pre[0], post[0]):
+                _drop(jobs[jid], 'drop_empty')
+
+    if keep_baselines is not None:
+        for snapshots in baselines.values():
+            snapshots = sorted(snapshots, key=lambda s: (s.timestamp, s.id), reverse=True)
+            _drop(snapshots[int(keep_baselines):], 'keep_baselines')
+
+    sizes = _get_used_space(config, [s.id for jid in jids for s in jobs[jid]] +
+                            [s.id for tag in baselines for s in baselines[tag]])
+
+    if space_budget is not None:
+        remaining = [jid for jid in jids if not all(s.id in reasons for s in jobs[jid])]
+        used = [sizes[s.id] for jid in remaining for s in jobs[jid]]
+        if None in used:
+            raise CommandExecutionError(
+                'Unable to apply space_budget: snapper cannot calculate the '
+                'space used by snapshots in config {0}'.format(config))
+        used = sum(used)
+        while remaining and used > int(space_budget):
+            jid = remaining.pop()
+            used -= sum(sizes[s.id] for s in jobs[jid])
+            _drop(jobs[jid], 'space_budget')
+
+    numbers = sorted(reasons)
+    if numbers and not test:
+        try:
+            snapper.DeleteSnapshots(config, numbers)
+        except dbus.DBusException as exc:
+            raise CommandExecutionError(
+                'Error encountered while deleting snapshots: {0}'
+                .format(_dbus_exception_to_reason(exc, locals()))
+            )
+        _cache_invalidate(config, numbers)
+
+    known_sizes = [sizes[number] for number in numbers if sizes.get(number) is not None]
+    return {
+        'test': bool(test),
+        'snapshots': dict((number, {'reason': reasons[number], 'size': sizes.get(number)})
+                          for number in numbers),
+        'reclaimed': sum(known_sizes) if len(known_sizes) == len(numbers) else None,
+        'time': round(time.time() - start, 3),
+    }
+
+
+def export(config='root', num_pre=None, num_post=None, jid=None, compression='gz',
+           part_size=EXPORT_PART_SIZE):
+    '''
+    Exports the files changed between two snapshots as tar archives in the
+    ``snapper/export/<config>-<pre>-<post>`` directory of the minion
+    cachedir.
+
+    The archives contain the version of the changed files in num_post, plus
+    a ``MANIFEST.json`` file with the numeric snapper status of every
+    changed file and the list of deleted files. The files are streamed from
+    the snapshot into the archives, which are split into parts of about
+    ``part_size`` bytes. If an export is interrupted, calling this function
+    again with the same compression resumes it from the last complete part.
+    Otherwise the export starts over and the parts already in the directory
+    are removed.
+
+    config
+        Configuration name.
+
+    num_pre
+        first snapshot ID to compare. Default is last snapshot
+
+    num_post
+        last snapshot ID to compare. Default is 0 (current state). Exports
+        of the current state are never resumed, the parts of a previous
+        export are removed instead.
+
+    jid
+        Export the changes done by this salt job instead of num_pre and
+        num_post.
+
+    compression
+        Compression of the archives: gz, bz2 or an empty string for none.
+        Default is gz
+
+    part_size
+        Bytes of file contents stored in every archive part. Default is 1GiB
+
+    CLI example:
+
+    .. code-block:: bash
+
+        salt '*' snapper.export num_pre=19 num_post=20
+        salt '*' snapper.export jid=20160607130930720112 compression=bz2
+    '''
+    if compression not in ('', 'gz', 'bz2'):
+        raise CommandExecutionError(
+            "Invalid compression '{0}', use gz, bz2 or ''".format(compression))
+
+    start = time.time()
+    if jid is not None:
+        pre, post = _get_jid_snapshots(jid, config=config)
+    else:
+        pre, post = _get_num_interval(config, num_pre, num_post)
+
+    export_dir = _get_cache_dir(os.path.join('export', '{0}-{1}-{2}'.format(config, pre, post)))
+    if not export_dir:
+        raise CommandExecutionError('Unable to create the export directory')
+    progress_path = os.path.join(export_dir, 'progress.json')
+
+    progress = None
+    if post:
+        try:
+            with salt.utils.fopen(progress_path, 'r') as progress_file:
+                progress = json.load(progress_file)
+        except (IOError, OSError, ValueError):
+            pass
+    if not progress or progress.get('compression') != compression:
+        progress = {'compression': compression, 'done': 0, 'parts': [], 'files': 0, 'bytes': 0}
+        # Starting over, do not leave parts of a previous export behind
+        for path in glob.glob(os.path.join(export_dir, 'part-*')) + [progress_path]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    resumed = progress['done'] > 0
+
+    try:
+        files = _get_files_status(config, pre, post)
+    except dbus.DBusException as exc:
+        raise CommandExecutionError(
+            'Error encountered while exporting changed files: {0}'
+            .format(_dbus_exception_to_reason(exc, locals()))
+        )
+    paths = sorted(files)
+    deleted = [path for path in paths if files[path] & 2]
+
+    post_mount = _mount_snapshot(config, post)
+    try:
+        index = progress['done']
+        while True:
+            # Deleted files are only listed in the manifest
+            while index < len(paths) and not os.path.lexists(post_mount + paths[index]):
+                index += 1
+            if index >= len(paths) and progress['parts']:
+                break
+
+            part = 'part-{0:04d}.tar{1}'.format(len(progress['parts']),
+                                                '.' + compression if compression else '')
+            size = 0
+            tar = tarfile.open(os.path.join(export_dir, part), 'w:' + compression)
+            try:
+                if not progress['parts']:
+                    manifest = json.dumps({'config': config, 'pre': pre, 'post': post,
+                                           'files': files, 'deleted': deleted}).encode('utf-8')
+                    info = tarfile.TarInfo('MANIFEST.json')
+                    info.size = len(manifest)
+                    info.mtime = int(start)
+                    tar.addfile(info, io.BytesIO(manifest))
+
+                while index < len(paths) and size < int(part_size):
+                    source = post_mount + paths[index]
+                    index += 1
+                    if not os.path.lexists(source):
+                        continue
+                    info = tar.gettarinfo(source, arcname=paths[index - 1].lstrip('/'))
+                    if info is None:
+                        # Sockets cannot be archived
+                        continue
+                    if info.isreg():
+                        with salt.utils.fopen(source, 'rb') as source_file:
+                            tar.addfile(info, source_file)
+                    else:
+                        tar.addfile(info)
+                    size += info.size
+                    progress['files'] += 1
+            finally:
+                tar.close()
+
+            _COUNTERS['bytes_read'] += size
+            progress['parts'].append(part)
+            progress['done'] = index
+            progress['bytes'] += size
+            _cache_write(progress_path, progress)
+    finally:
+        _umount_snapshot(config, post)
+
+    return {
+        'directory': export_dir,
+        'parts': progress['parts'],
+        'files': progress['files'],
+        'deleted': len(deleted),
+        'bytes': progress['bytes'],
+        'resumed': resumed,
+        'time': round(time.time() - start, 3),
+    }
+
+
+def _manifest_path(config, number):
+    '''
+    Returns the file of the manifest of a baseline snapshot, or None if
+    there is no cachedir available
+    '''
+    cache_dir = _get_cache_dir('manifest')
+    return os.path.join(cache_dir, '{0}.{1}.json'.format(config, number)) if cache_dir else None
+
+
+def _walk_files(mount, paths):
+    '''
+    Yields the path, relative to `mount`, and the lstat of every file under
+    the given paths, not descending into other filesystems or subvolumes
+    nor into the .snapshots directory
+    '''
+    mount = mount.rstrip('/')
+    for path in paths:
+        top = (mount + '/' + path.strip('/')).rstrip('/') or '/'
+        try:
+            top_stat = os.lstat(top)
+        except OSError:
+            continue
+        if not stat.S_ISDIR(top_stat.st_mode):
+            yield top[len(mount):], top_stat
+            continue
+        for dirpath, dirnames, filenames in os.walk(top):
+            subdirs = []
+            for name in dirnames:
+                full_path = os.path.join(dirpath, name)
+                try:
+                    file_stat = os.lstat(full_path)
+                except OSError:
+                    continue
+                if stat.S_ISLNK(file_stat.st_mode):
+                    yield full_path[len(mount):], file_stat
+                elif file_stat.st_dev == top_stat.st_dev and \
+                        full_path[len(mount):] != '/.snapshots':
+                    subdirs.append(name)
+            dirnames[:] = subdirs
+            for name in filenames:
+                full_path = os.path.join(dirpath, name)
+                try:
+                    yield full_path[len(mount):], os.lstat(full_path)
+                except OSError:
+                    continue
+
+
+def _entry_hash(filename, file_stat):
+    '''
+    Returns the sha256 digest of a regular file or of the target of a
+    symbolic link, None for other types of files
+    '''
+    try:
+        if stat.S_ISLNK(file_stat.st_mode):
+            target = os.readlink(filename)
+            if not isinstance(target, bytes):
+                target = target.encode('utf-8')
+            return hashlib.sha256(target).hexdigest()
+        if stat.S_ISREG(file_stat.st_mode):
+            return _file_digest(filename)
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def _build_manifest(config, number, paths):
+    '''
+    Returns the size, mtime, mode and digest of every file under the given
+    paths in a snapshot
+    '''
+    mount = _mount_snapshot(config, number)
+    try:
+        files = {}
+        for path, file_stat in _walk_files(mount, paths):
+            files[path] = [file_stat.st_size, file_stat.st_mtime, file_stat.st_mode,
+                           _entry_hash(mount.rstrip('/') + path, file_stat)]
+        return files
+    finally:
+        _umount_snapshot(config, number)
+
+
+def create_baseline(tag="baseline", config='root', manifest=None):
     '''
     Creates a snapshot marked as baseline
 
@@ -673,15 +2709,132 @@ def create_baseline(tag="baseline", config='root'):
     config
         Configuration name.
 
+    manifest
+        List of paths (or comma separated string) to record the size,
+        mtime, mode and sha256 digest of every file under them, as found in
+        the baseline snapshot. The manifest is kept in the minion cachedir
+        and used by :py:func:`snapper.verify_baseline
+        <salt.modules.snapper.verify_baseline>`. Default is None (no manifest)
+
     CLI example:
 
     .. code-block:: bash
 
         salt '*' snapper.create_baseline
         salt '*' snapper.create_baseline my_custom_baseline
+        salt '*' snapper.create_baseline manifest=/etc,/usr/local/bin
+    '''
+    number = __salt__['snapper.create_snapshot'](config=config,
+                                                 snapshot_type='single',
+                                                 description="baseline snapshot",
+                                                 cleanup_algorithm="number",
+                                                 userdata={"baseline_tag": tag})
+    if manifest:
+        if not isinstance(manifest, (list, tuple)):
+            manifest = [path.strip() for path in str(manifest).split(',') if path.strip()]
+        path = _manifest_path(config, number)
+        if not path:
+            raise CommandExecutionError('A minion cachedir is needed to keep the manifest')
+        try:
+            files = _build_manifest(config, number, manifest)
+        except dbus.DBusException as exc:
+            raise CommandExecutionError(
+                'Error encountered while building the manifest of snapshot {0}: {1}'
+                .format(number, _dbus_exception_to_reason(exc, locals()))
+            )
+        _cache_write(path, {'config': config, 'number': number, 'tag': tag,
+                            'paths': list(manifest), 'files': files})
+        log.debug('Recorded %s files in the manifest of snapshot %s', len(files), number)
+    return number
+
+
+def verify_baseline(tag='baseline', config='root', number=None, workers=1):
+    '''
+    Compares the current system against the manifest of a baseline snapshot
+    made with :py:func:`snapper.create_baseline
+    <salt.modules.snapper.create_baseline>`, without asking snapper for a
+    comparison.
+
+    Only files with a different size, mtime or mode than in the manifest are
+    read, and only when their size and type did not change, to tell content
+    changes from metadata changes.
+
+    tag
+        Tag name of the baseline. The newest snapshot with this tag is used
+
+    config
+        Configuration name.
+
+    number
+        Number of the baseline snapshot, instead of the tag
+
+    workers
+        Number of files hashed at the same time. Default is 1
+
+    Returns the ``status`` of every changed file, like :py:func:`snapper.status
+    <salt.modules.snapper.status>`, together with the number of files
+    ``checked`` and ``hashed``.
+
+    CLI example:
+
+    .. code-block:: bash
+
+        salt '*' snapper.verify_baseline
+        salt '*' snapper.verify_baseline number=42 workers=4
     '''
-    return __salt__['snapper.create_snapshot'](config=config,
-                                               snapshot_type='single',
-                                               description="baseline snapshot",
-                                               cleanup_algorithm="number",
-                                               userdata={"baseline_tag": tag})
+    if number is None:
+        snapshots = _list_snapshots(config, userdata={'baseline_tag': tag},
+                                    order_by='timestamp', reverse=True, limit=1)
+        if not snapshots:
+            raise CommandExecutionError('Baseline tag "{0}" not found'.format(tag))
+        number = snapshots[0].id
+    number = int(number)
+
+    path = _manifest_path(config, number)
+    try:
+        with salt.utils.fopen(path) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (IOError, OSError, TypeError, ValueError):
+        raise CommandExecutionError('Snapshot {0} has no manifest'.format(number))
+
+    mount = _mount_snapshot(config, 0).rstrip('/')
+    expected = manifest['files']
+    files = {}
+    to_hash = []
+    seen = set()
+    for file_path, file_stat in _walk_files(mount, manifest['paths']):
+        seen.add(file_path)
+        entry = expected.get(file_path)
+        if entry is None:
+            files[file_path] = ['created']
+            continue
+        size, mtime, mode, _ = entry
+        actions = []
+        if stat.S_IFMT(mode) != stat.S_IFMT(file_stat.st_mode):
+            actions.append('type changed')
+        elif file_stat.st_size != size:
+            actions.append('modified')
+        elif file_stat.st_mtime != mtime:
+            to_hash.append((file_path, file_stat))
+        if stat.S_IMODE(mode) != stat.S_IMODE(file_stat.st_mode):
+            actions.append('permission changed')
+        if actions:
+            files[file_path] = actions
+
+    for file_path in set(expected) - seen:
+        files[file_path] = ['deleted']
+
+    def _hash(item):
+        return item[0], _entry_hash(mount + item[0], item[1])
+
+    pool = ThreadPool(max(min(int(workers), len(to_hash)), 1))
+    try:
+        for file_path, digest in pool.imap_unordered(_hash, to_hash):
+            if digest != expected[file_path][3]:
+                files.setdefault(file_path, []).insert(0, 'modified')
+    finally:
+        pool.close()
+        pool.join()
+
+    ret = dict((file_path, {'status': actions}) for file_path, actions in files.items())
+    return {'baseline': number, 'files': ret, 'checked': len(seen), 'hashed': len(to_hash)}
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+'''
+Master side helpers for the snapper execution module
+
+The ``status``, ``changed_files``, ``diff`` and ``diff_jid`` functions of the
+snapper execution module accept ``compact=True`` to return a smaller payload:
+paths are grouped by directory, status values are kept as the numeric
+snapper bitmask and diff bodies are zlib compressed. This runner expands
+those returns back to the regular format.
+
+The ``batch`` function runs a snapper function on a fleet of minions a few
+at a time, stopping early when too many of them fail, and reports the time
+taken by every minion.
+
+:maturity:      new
+:platform:      Linux
+'''
+
+from __future__ import absolute_import
+
+import base64
+import logging
+import threading
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
+
+import salt.client
+import salt.utils.minions
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+# Keep in sync with the snapper execution module
+DBUS_STATUS_MAP = {
+    1: "created",
+    2: "deleted",
+    4: "type changed",
+    8: "modified",
+    16: "permission changed",
+    32: "owner changed",
+    64: "group changed",
+    128: "extended attributes changed",
+    256: "ACL info changed",
+}
+
+COMPACT_FORMAT = 'snapper.compact/1'
+
+# Keys of the compact returns which are not paths
+EXTRA_KEYS = ('incomplete', 'throttle')
+
+
+def _status_to_string(dbus_status):
+    '''
+    Converts a numeric dbus snapper status into a string
+    '''
+    return [DBUS_STATUS_MAP[bit] for bit in sorted(DBUS_STATUS_MAP) if dbus_status & bit]
+
+
+def _decompress_text(text):
+    '''
+    Returns the text of a base64 encoded zlib compressed text
+    '''
+    return zlib.decompress(base64.b64decode(text)).decode('utf-8')
+
+
+def _ungroup(grouped):
+    '''
+    Returns a dict keyed by absolute paths from a dict of directories
+    '''
+    files = {}
+    for dirname, names in grouped.items():
+        for name, value in names.items():
+            files[dirname.rstrip('/') + '/' + name if name else dirname] = value
+    return files
+
+
+def _decode_one(data):
+    '''
+    Expands a single compact return, other values are returned untouched
+    '''
+    if not isinstance(data, dict) or data.get('format') != COMPACT_FORMAT:
+        return data
+
+    extra = dict((key, data[key]) for key in EXTRA_KEYS if key in data)
+
+    if 'status' in data:
+        files_status = dict((path, {'status': _status_to_string(value)})
+                            for path, value in _ungroup(data['status']).items())
+        files_status.update(extra)
+        return files_status
+
+    if 'files' in data:
+        return sorted(dirname.rstrip('/') + '/' + name if name else dirname
+                      for dirname, names in data['files'].items() for name in names)
+
+    files_diff = _ungroup(data['diff'])
+    for file_diff in files_diff.values():
+        if 'diff' in file_diff:
+            file_diff['diff'] = _decompress_text(file_diff['diff'])
+    files_diff.update(extra)
+    return files_diff
+
+
+def decode(data):
+    '''
+    Expands the compact return of a snapper execution module function.
+
+    data
+        Either the return of a single minion or a dict mapping minion ids
+        to their returns, as given by ``LocalClient.cmd``.
+
+    .. code-block:: python
+
+        import salt.client
+        import salt.runner
+
+        ret = salt.client.LocalClient().cmd('*', 'snapper.status', kwarg={'compact': True})
+        ret = salt.runner.RunnerClient(__opts__).cmd('snapper.decode', [ret])
+    '''
+    if isinstance(data, dict) and data.get('format') != COMPACT_FORMAT:
+        return dict((minion, _decode_one(ret)) for minion, ret in data.items())
+    return _decode_one(data)
+
+
+# Default seconds to wait for every minion in batch(). Undoing or diffing a
+# job can take minutes, much longer than the master timeout.
+BATCH_TIMEOUT = 600
+
+# Functions of the execution module accepting compact=True
+COMPACT_FUNCTIONS = ('snapper.status', 'snapper.changed_files', 'snapper.diff', 'snapper.diff_jid')
+
+
+def _percentile(values, percent):
+    '''
+    Returns the nearest-rank percentile of sorted values
+    '''
+    index = max(int(round(percent / 100.0 * len(values))) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def _max_failures(max_failures, count):
+    '''
+    Returns the number of failed minions allowed, given as a number or as a
+    percentage of the targeted minions
+    '''
+    if max_failures is None:
+        return None
+    if str(max_failures).endswith('%'):
+        return int(count * float(str(max_failures)[:-1]) / 100)
+    return int(max_failures)
+
+
+def _failed(minion_ret):
+    '''
+    Returns True if the job failed on the minion, from its retcode or the
+    ``ERROR`` prefix the minion gives to the exceptions of the modules
+    '''
+    if minion_ret.get('retcode', 0):
+        return True
+    ret = minion_ret.get('ret')
+    return isinstance(ret, (type(''), type(u''))) and ret.startswith('ERROR')
+
+
+def batch(tgt, fun, arg=None, kwarg=None, expr_form='glob', concurrency=10,
+          timeout=None, max_failures=None, compact=True, returns=True):
+    '''
+    Runs a snapper execution module function on the targeted minions, at
+    most ``concurrency`` minions at a time.
+
+    tgt
+        Target of the minions
+
+    fun
+        Function of the snapper execution module, like ``snapper.undo_jid``
+        or ``diff_jid``
+
+    arg, kwarg
+        Arguments of the function
+
+    expr_form
+        Type of target. Default is glob
+
+    concurrency
+        Number of minions running the function at the same time. Every
+        minion starts as soon as another one finishes. Default is 10
+
+    timeout
+        Seconds to wait for every minion. A minion not returning in time is
+        counted as failed and its slot is given to the next minion, while
+        the job may still be running on it. Default is 600
+
+    max_failures
+        Number of failed minions, or percentage of the targeted minions like
+        ``10%``, after which no more minions are started. Minions failing
+        are the ones not returning in time, returning a non zero retcode or
+        an error raised by the module.
+        Default is None (run on every minion)
+
+    compact
+        Request the compact format to the functions supporting it and
+        expand it on the master. Default is True
+
+    returns
+        Include the return of every minion. With False only the summary and
+        the timing are returned. Default is True
+
+    The minions targeted but not answering a first ``test.ping`` are not run
+    and are listed under ``no_response`` in the summary.
+
+    CLI example:
+
+    .. code-block:: bash
+
+        salt-run snapper.batch '*' snapper.undo_jid arg='[20160607130930720112]' concurrency=5 max_failures=10%
+        salt-run snapper.batch 'web*' diff_jid kwarg='{jid: 20160607130930720112}' returns=False
+    '''
+    if not fun.startswith('snapper.'):
+        fun = 'snapper.' + fun
+    arg = list(arg or [])
+    kwarg = dict(kwarg or {})
+    if compact and fun in COMPACT_FUNCTIONS:
+        kwarg['compact'] = True
+    timeout = int(timeout or BATCH_TIMEOUT)
+
+    targeted = salt.utils.minions.CkMinions(__opts__).check_minions(tgt, expr_form)
+    if isinstance(targeted, dict):
+        targeted = targeted.get('minions', [])
+    client = salt.client.LocalClient(__opts__['conf_file'])
+    minions = sorted(client.cmd(tgt, 'test.ping', timeout=__opts__.get('timeout', 5),
+                                expr_form=expr_form))
+    no_response = sorted(set(targeted) - set(minions))
+    allowed_failures = _max_failures(max_failures, len(minions))
+
+    state = {'failed': 0, 'aborted': False}
+    lock = threading.Lock()
+
+    def _run(minion):
+        with lock:
+            if state['aborted']:
+                return minion, {'result': None, 'comment': 'Skipped after too many failures'}
+        start = time.time()
+        ret = {}
+        for minion_ret in salt.client.LocalClient(__opts__['conf_file']).cmd_iter(
+                minion, fun, arg, timeout=timeout, expr_form='list', kwarg=kwarg):
+            ret.update(minion_ret)
+        elapsed = round(time.time() - start, 3)
+        if minion not in ret:
+            result = {'result': False, 'time': elapsed, 'comment': 'Minion did not return'}
+        elif _failed(ret[minion]):
+            result = {'result': False, 'time': elapsed, 'comment': ret[minion].get('ret'),
+                      'retcode': ret[minion].get('retcode', 0)}
+        else:
+            result = {'result': True, 'time': elapsed}
+            if returns:
+                result['ret'] = decode(ret[minion].get('ret'))
+        if not result['result']:
+            with lock:
+                state['failed'] += 1
+                if allowed_failures is not None and state['failed'] > allowed_failures:
+                    if not state['aborted']:
+                        log.error('Stopping %s after %s failed minions', fun, state['failed'])
+                    state['aborted'] = True
+        return minion, result
+
+    pool = ThreadPool(max(min(int(concurrency), len(minions)), 1))
+    try:
+        results = dict(pool.imap_unordered(_run, minions))
+    finally:
+        pool.close()
+        pool.join()
+
+    times = sorted(result['time'] for result in results.values() if 'time' in result)
+    summary = {
+        'minions': len(minions),
+        'succeeded': len([r for r in results.values() if r['result']]),
+        'failed': len([r for r in results.values() if r['result'] is False]),
+        'skipped': len([r for r in results.values() if r['result'] is None]),
+        'aborted': state['aborted'],
+        'no_response': no_response,
+    }
+    timing = {}
+    if times:
+        timing = {'min': times[0], 'max': times[-1],
+                  'mean': round(sum(times) / len(times), 3),
+                  'p50': _percentile(times, 50), 'p90': _percentile(times, 90),
+                  'p99': _percentile(times, 99)}
+    return {'summary': summary, 'timing': timing, 'minions': results}
@@ -97,7 +97,10 @@ and include this change.
 
 from __future__ import absolute_import
 
+import contextlib
+import cProfile
 import os
+import time
 
 
 def __virtual__():
@@ -107,26 +110,102 @@ def __virtual__():
     return 'snapper' if 'snapper.diff' in __salt__ else False
 
 
-def _get_baseline_from_tag(tag):
+def _get_baseline_from_tag(config, tag):
     '''
     Returns the last created baseline snapshot marked with `tag`
     '''
-    last_snapshot = None
-    for snapshot in __salt__['snapper.list_snapshots']():
-        if tag == snapshot['userdata'].get("baseline_tag"):
-            if not last_snapshot or last_snapshot['timestamp'] < snapshot['timestamp']:
-                last_snapshot = snapshot
-    return last_snapshot
+    snapshots = __salt__['snapper.list_snapshots'](config,
+                                                  userdata={'baseline_tag': tag},
+                                                  order_by='timestamp',
+                                                  reverse=True, limit=1)
+    return snapshots[0] if snapshots else None
 
 
-def baseline_snapshot(name, number=None, tag=None, config='root', ignore=None):
+@contextlib.contextmanager
+def _phase(phases, phase):
+    '''
+    Adds the wall time spent in the block to the given phase
+    '''
+    start = time.time()
+    try:
+        yield
+    finally:
+        phases[phase] = phases.get(phase, 0) + time.time() - start
+
+
+def baseline_snapshot(name, number=None, tag=None, config='root', ignore=None,
+                      workers=1, profile=False, profile_dump=False, throttle=None):
     '''
     Enforces that no file is modified comparing against a previously
     defined snapshot identified by number.
 
     ignore
         List of files to ignore
+
+    workers
+        Number of top-level directories restored in parallel when undoing
+        the changes. Default is 1
+
+    throttle
+        Dict with the ``nice``, ``ionice``, ``bytes_per_second`` and
+        ``files_per_second`` limits used to diff the changed files, see
+        :py:func:`snapper.diff <salt.modules.snapper.diff>`. Undoing them
+        only uses ``nice`` and ``ionice``. Default is the ``snapper.throttle``
+        minion option
+
+    profile
+        Add a ``profile`` entry to the state return with the wall time of
+        every phase, the number of D-Bus calls, the bytes read from the
+        snapshots and the number of files processed. Default is False
+
+    profile_dump
+        Also run the state under cProfile and write the stats into the
+        ``snapper`` directory of the minion cachedir. Default is False
     '''
+    if not profile and not profile_dump:
+        return _baseline_snapshot(name, number, tag, config, ignore, workers, throttle, {})
+
+    stats = {'phases': {}}
+    __salt__['snapper.get_counters'](reset=True)
+    profiler = cProfile.Profile() if profile_dump else None
+    start = time.time()
+    if profiler:
+        profiler.enable()
+    try:
+        ret = _baseline_snapshot(name, number, tag, config, ignore, workers, throttle,
+                                 stats)
+    finally:
+        if profiler:
+            profiler.disable()
+
+    stats.update(__salt__['snapper.get_counters']())
+    stats['total'] = time.time() - start
+    for phase in stats['phases']:
+        stats['phases'][phase] = round(stats['phases'][phase], 3)
+    stats['total'] = round(stats['total'], 3)
+
+    if profiler:
+        path = os.path.join(__opts__['cachedir'], 'snapper',
+                            'baseline_snapshot-{0}-{1}.prof'.format(name.replace(os.sep, '_'),
+                                                                     int(start)))
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            profiler.dump_stats(path)
+            stats['cprofile'] = path
+        except (IOError, OSError) as exc:
+            stats['cprofile'] = 'Unable to write {0}: {1}'.format(path, exc)
+
+    ret['profile'] = stats
+    return ret
+
+
+def _baseline_snapshot(name, number, tag, config, ignore, workers, throttle, stats):
+    '''
+    Implements baseline_snapshot, recording the time of every phase and the
+    number of processed files in `stats`
+    '''
+    phases = stats.setdefault('phases', {})
     if not ignore:
         ignore = []
 
@@ -146,32 +225,41 @@ def baseline_snapshot(name, number=None, tag=None, config='root', ignore=None):
         return ret
 
     if tag:
-        snapshot = _get_baseline_from_tag(tag)
+        with _phase(phases, 'baseline_lookup'):
+            snapshot = _get_baseline_from_tag(config, tag)
         if not snapshot:
             ret.update({'result': False,
                         'comment': 'Baseline tag "{0}" not found'.format(tag)})
             return ret
         number = snapshot['id']
 
-    status = __salt__['snapper.status'](
-        config, num_pre=number, num_post=0)
-
-    for target in ignore:
-        if os.path.isfile(target):
-            status.pop(target, None)
-        elif os.path.isdir(target):
-            for target_file in [target_file for target_file in status.keys() if target_file.startswith(target)]:
-                status.pop(target_file, None)
+    with _phase(phases, 'status'):
+        status = __salt__['snapper.status'](
+            config, num_pre=number, num_post=0)
+    stats['files_changed'] = len(status)
+
+    with _phase(phases, 'ignore'):
+        for target in ignore:
+            if os.path.isfile(target):
+                status.pop(target, None)
+            elif os.path.isdir(target):
+                for target_file in [target_file for target_file in status.keys() if target_file.startswith(target)]:
+                    status.pop(target_file, None)
+    stats['files_processed'] = len(status)
+    stats['files_diffed'] = 0
 
     for file in status:
         status[file]['actions'] = status[file].pop("status")
 
         # Only include diff for modified files
         if "modified" in status[file]['actions']:
-            status[file].update(__salt__['snapper.diff'](config,
-                                                         num_pre=0,
-                                                         num_post=number,
-                                                         filename=file)[file])
+            stats['files_diffed'] += 1
+            with _phase(phases, 'diff'):
+                status[file].update(__salt__['snapper.diff'](config,
+                                                             num_pre=0,
+                                                             num_post=number,
+                                                             filename=file,
+                                                             throttle=throttle)[file])
 
     if __opts__['test'] and status:
         ret['pchanges'] = ret["changes"]
@@ -183,8 +271,10 @@ def baseline_snapshot(name, number=None, tag=None, config='root', ignore=None):
         ret['comment'] = "Nothing to be done"
         ret['result'] = True
     elif not __opts__['test'] and status:
-        undo = __salt__['snapper.undo'](config, num_pre=number, num_post=0,
-                                        files=status.keys())
+        with _phase(phases, 'undo'):
+            undo = __salt__['snapper.undo'](config, num_pre=number, num_post=0,
+                                            files=status.keys(), workers=workers,
+                                            throttle=throttle)
         ret['changes']['sumary'] = undo
         ret['changes']['files'] = status
         ret['result'] = True
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+'''
+Unit tests for the Snapper beacon
+'''
+
+from __future__ import absolute_import
+
+from salttesting import TestCase
+from salttesting.mock import (
+    MagicMock,
+    patch,
+)
+from salttesting.helpers import ensure_in_syspath
+ensure_in_syspath('../../')
+
+from salt.beacons import snapper
+
+# Globals
+snapper.__salt__ = dict()
+
+STATUS_RET = {
+    'format': 'snapper.compact/1',
+    'status': {'/etc': {'passwd': 8}, '/var/log': {'messages': 8}},
+}
+
+
+@patch('salt.beacons.snapper._subscribe', MagicMock())
+@patch('salt.beacons.snapper._process_signals', MagicMock())
+class SnapperBeaconTestCase(TestCase):
+    def setUp(self):
+        snapper._PENDING.clear()  # pylint: disable=protected-access
+        snapper._DRIFT.clear()  # pylint: disable=protected-access
+        snapper._CHECKED.clear()  # pylint: disable=protected-access
+
+    def test_validate(self):
+        self.assertEqual(snapper.__validate__([{'tag': 'baseline'}])[0], True)
+        self.assertEqual(snapper.__validate__([{'tag': 'baseline'}, {'number': 20}])[0], False)
+        self.assertEqual(snapper.__validate__({'config': 'root'})[0], False)
+        self.assertEqual(snapper.__validate__({'number': 20, 'ignore': '/var/log'})[0], False)
+        self.assertEqual(snapper.__validate__({'number': 20, 'interval': 3600, 'timeout': 5})[0], True)
+        self.assertEqual(snapper.__validate__({'number': 20, 'interval': 'hourly'})[0], False)
+        self.assertEqual(snapper.__validate__({'number': 20, 'timeout': 0})[0], False)
+
+    def test_beacon(self):
+        status_mock = MagicMock(return_value=STATUS_RET)
+        with patch.dict(snapper.__salt__, {'snapper.status': status_mock}):
+            config = [{'number': 20}, {'ignore': ['/var/log']}]
+            ret = snapper.beacon(config)
+            self.assertEqual(len(ret), 1)
+            self.assertEqual(ret[0]['tag'], 'root')
+            self.assertEqual(ret[0]['baseline'], 20)
+            self.assertEqual(ret[0]['files'], 1)
+            self.assertTrue(ret[0]['drift'])
+            status_mock.assert_called_with('root', num_pre=20, num_post=0, compact=True, timeout=10.0)
+
+            # Nothing is checked again until snapper sends a signal
+            self.assertEqual(snapper.beacon(config), [])
+            self.assertEqual(status_mock.call_count, 1)
+
+            # A signal without drift changes does not fire an event
+            snapper._on_signal('root', 21, member='SnapshotCreated')  # pylint: disable=protected-access
+            self.assertEqual(snapper.beacon(config), [])
+            self.assertEqual(status_mock.call_count, 2)
+
+            status_mock.return_value = {'format': 'snapper.compact/1', 'status': {}}
+            snapper._on_signal('root', [21], member='SnapshotsDeleted')  # pylint: disable=protected-access
+            ret = snapper.beacon(config)
+            self.assertEqual(ret[0]['files'], 0)
+            self.assertFalse(ret[0]['drift'])
+
+    @patch('salt.beacons.snapper.time.time')
+    def test_beacon_interval(self, time_mock):
+        status_mock = MagicMock(return_value=STATUS_RET)
+        with patch.dict(snapper.__salt__, {'snapper.status': status_mock}):
+            config = [{'number': 20}, {'interval': 60}]
+            time_mock.return_value = 1000
+            self.assertEqual(len(snapper.beacon(config)), 1)
+            time_mock.return_value = 1030
+            self.assertEqual(snapper.beacon(config), [])
+            self.assertEqual(status_mock.call_count, 1)
+
+            # Files edited on the live system are seen without a signal
+            status_mock.return_value = {'format': 'snapper.compact/1', 'status': {}}
+            time_mock.return_value = 1060
+            ret = snapper.beacon(config)
+            self.assertEqual(status_mock.call_count, 2)
+            self.assertFalse(ret[0]['drift'])
+
+    def test_beacon_timeout(self):
+        status_mock = MagicMock(return_value={'format': 'snapper.compact/1', 'status': {},
+                                              'incomplete': {'reason': 'timeout', 'num_pre': 20,
+                                                             'num_post': 0, 'cursor': None}})
+        with patch.dict(snapper.__salt__, {'snapper.status': status_mock}):
+            config = [{'number': 20}, {'timeout': 5}]
+            self.assertEqual(snapper.beacon(config), [])
+            self.assertEqual(status_mock.call_args[1]['timeout'], 5.0)
+
+            # Only retried after the next signal
+            self.assertEqual(snapper.beacon(config), [])
+            self.assertEqual(status_mock.call_count, 1)
+            status_mock.return_value = STATUS_RET
+            snapper._on_signal('root', 21, member='SnapshotCreated')  # pylint: disable=protected-access
+            self.assertEqual(len(snapper.beacon(config)), 1)
+
+    def test_beacon_baseline_error(self):
+        list_mock = MagicMock(side_effect=Exception('snapper is not running'))
+        status_mock = MagicMock(return_value=STATUS_RET)
+        with patch.dict(snapper.__salt__, {'snapper.list_snapshots': list_mock,
+                                           'snapper.status': status_mock}):
+            self.assertEqual(snapper.beacon([{'tag': 'baseline'}]), [])
+            self.assertFalse(status_mock.called)
+
+
+if __name__ == '__main__':
+    from integration import run_tests
+    run_tests(SnapperBeaconTestCase, needs_daemon=False)
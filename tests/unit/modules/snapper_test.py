@@ -8,6 +8,14 @@ Unit tests for the Snapper module
 
 from __future__ import absolute_import
 
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+
 from salttesting import TestCase
 from salttesting.mock import (
     MagicMock,
@@ -23,6 +31,7 @@ from salt.modules import snapper
 
 # Globals
 snapper.__salt__ = dict()
+snapper.__opts__ = dict()
 
 DBUS_RET = {
     'ListSnapshots': [
@@ -48,6 +57,7 @@ DBUS_RET = {
             u'SYNC_ACL': u'no', u'QGROUP': u'1/0'}
         ]
     ],
+    'GetConfig': [u'root', u'/', {u'SUBVOLUME': u'/', u'FSTYPE': u'lvm(ext4)'}],
     'GetFiles': [
         ['/root/.viminfo', 8],
         ['/tmp/foo', 52],
@@ -139,6 +149,9 @@ class SnapperTestCase(TestCase):
         self.dbus_mock.configure_mock(DBusException=self.DBusExceptionMock)
         snapper.dbus = self.dbus_mock
         snapper.snapper = MagicMock()
+        snapper.snapper.GetConfig.return_value = DBUS_RET['GetConfig']
+        snapper._CONFIGS.clear()  # pylint: disable=protected-access
+        snapper._CONFIGS_LISTED['time'] = None  # pylint: disable=protected-access
 
     def test__snapshot_to_data(self):
         data = snapper._snapshot_to_data(DBUS_RET['ListSnapshots'][0])  # pylint: disable=protected-access
@@ -151,10 +164,50 @@ class SnapperTestCase(TestCase):
         self.assertEqual(data['cleanup'], '')
         self.assertEqual(data['userdata']['userdata1'], 'userval1')
 
+    def test__snapshot(self):
+        snapshot = snapper._Snapshot(DBUS_RET['ListSnapshots'][1])  # pylint: disable=protected-access
+        self.assertEqual((snapshot.id, snapshot.type, snapshot.pre), (43, 'post', 42))
+        self.assertEqual(snapshot['id'], 43)
+        self.assertIs(snapshot.userdata, DBUS_RET['ListSnapshots'][1][7])
+        self.assertEqual(snapshot.to_dict(), MODULE_RET['SNAPSHOTS'][1])
+        self.assertFalse(hasattr(snapshot, '__dict__'))
+
     @patch('salt.modules.snapper.snapper.ListSnapshots', MagicMock(return_value=DBUS_RET['ListSnapshots']))
     def test_list_snapshots(self):
         self.assertEqual(snapper.list_snapshots(), MODULE_RET["SNAPSHOTS"])
 
+    @patch('salt.modules.snapper.snapper.ListSnapshots', MagicMock(return_value=DBUS_RET['ListSnapshots']))
+    def test_list_snapshots_filters(self):
+        self.assertEqual(snapper.list_snapshots(snapshot_type='post'), MODULE_RET["SNAPSHOTS"][1:])
+        self.assertEqual(snapper.list_snapshots(userdata={'userdata1': 'userval1'}), MODULE_RET["SNAPSHOTS"][:1])
+        self.assertEqual(snapper.list_snapshots(start_time=1457006572), MODULE_RET["SNAPSHOTS"][1:])
+        self.assertEqual(snapper.list_snapshots(max_id=42, cleanup=''), MODULE_RET["SNAPSHOTS"][:1])
+        self.assertEqual(snapper.list_snapshots(userdata={'salt_jid': 'foo'}), [])
+        self.assertEqual(snapper.list_snapshots(order_by='timestamp', reverse=True),
+                         list(reversed(MODULE_RET["SNAPSHOTS"])))
+        self.assertEqual(snapper.list_snapshots(order_by='id', reverse=True, limit=1), MODULE_RET["SNAPSHOTS"][1:])
+        self.assertEqual(snapper._get_last_snapshot().to_dict(), MODULE_RET["SNAPSHOTS"][1])  # pylint: disable=protected-access
+        self.assertRaises(CommandExecutionError, snapper.list_snapshots, order_by='user')
+
+    def test_list_snapshots_shared_cache(self):
+        cachedir = tempfile.mkdtemp()
+        list_mock = MagicMock(return_value=DBUS_RET['ListSnapshots'])
+        version_mock = MagicMock(return_value=[43, 2, 1457006572.0, 1457006572.0])
+        try:
+            with patch.dict(snapper.__opts__, {'cachedir': cachedir}), \
+                    patch('salt.modules.snapper.snapper.ListSnapshots', list_mock), \
+                    patch('salt.modules.snapper._snapshots_version', version_mock):
+                self.assertEqual(snapper.list_snapshots(), MODULE_RET['SNAPSHOTS'])
+                self.assertEqual(snapper.list_snapshots(), MODULE_RET['SNAPSHOTS'])
+                self.assertEqual(snapper._get_jid_snapshots('20160607130930720112'), (42, 43))  # pylint: disable=protected-access
+                self.assertEqual(list_mock.call_count, 1)
+
+                version_mock.return_value = [44, 3, 1457006573.0, 1457006573.0]
+                snapper.list_snapshots()
+                self.assertEqual(list_mock.call_count, 2)
+        finally:
+            shutil.rmtree(cachedir)
+
     @patch('salt.modules.snapper.snapper.GetSnapshot', MagicMock(return_value=DBUS_RET['ListSnapshots'][0]))
     def test_get_snapshot(self):
         self.assertEqual(snapper.get_snapshot(), MODULE_RET["SNAPSHOTS"][0])
@@ -169,10 +222,58 @@ class SnapperTestCase(TestCase):
     def test_get_config(self):
         self.assertEqual(snapper.get_config(), DBUS_RET["ListConfigs"][0])
 
-    @patch('salt.modules.snapper.snapper.SetConfig', MagicMock())
-    def test_set_config(self):
-        opts = {'sync_acl': True, 'dummy': False, 'foobar': 1234}
-        self.assertEqual(snapper.set_config(opts), True)
+    @patch('salt.modules.snapper.snapper.ListConfigs', MagicMock(return_value=DBUS_RET['ListConfigs']))
+    @patch('salt.modules.snapper.snapper.GetConfig')
+    def test_config_cache(self, get_config_mock):
+        self.assertEqual(snapper.list_configs(), MODULE_RET["LISTCONFIGS"])
+        self.assertEqual(snapper.list_configs(), MODULE_RET["LISTCONFIGS"])
+        self.assertEqual(snapper.get_config()[2]['NUMBER_LIMIT'], '10')
+        self.assertEqual(snapper.snapper.ListConfigs.call_count, 1)
+        self.assertFalse(get_config_mock.called)
+
+        snapper.set_config(number_limit=20, sync_acl=True)
+        self.assertEqual(snapper.get_config()[2]['NUMBER_LIMIT'], '20')
+        self.assertEqual(snapper.get_config()[2]['SYNC_ACL'], 'yes')
+        self.assertFalse(get_config_mock.called)
+
+        get_config_mock.return_value = DBUS_RET['GetConfig']
+        with patch.dict(snapper.__opts__, {'snapper.config_cache_ttl': -1}):
+            self.assertEqual(snapper.get_config(), DBUS_RET['GetConfig'])
+            self.assertTrue(get_config_mock.called)
+
+    @patch('salt.modules.snapper.snapper.GetConfig',
+           MagicMock(return_value=[u'home', u'/home', {u'FSTYPE': u'btrfs'}]))
+    def test__mount_snapshot(self):
+        self.assertEqual(snapper._mount_snapshot('home', 0), '/home')  # pylint: disable=protected-access
+        self.assertEqual(snapper._mount_snapshot('home', 42), '/home/.snapshots/42/snapshot')  # pylint: disable=protected-access
+        snapper._umount_snapshot('home', 42)  # pylint: disable=protected-access
+        self.assertFalse(snapper.snapper.MountSnapshot.called)
+        self.assertFalse(snapper.snapper.UmountSnapshot.called)
+
+    @patch('salt.modules.snapper.snapper.SetConfig')
+    @patch('salt.modules.snapper.snapper.GetConfig', MagicMock(return_value=DBUS_RET['ListConfigs'][0]))
+    def test_set_config(self, set_config_mock):
+        opts = {'sync_acl': True, 'number_limit': 10, 'foobar': 1234}
+        self.assertEqual(snapper.set_config(**opts), {'root': {
+            'SYNC_ACL': {'old': 'no', 'new': 'yes'},
+            'FOOBAR': {'old': None, 'new': '1234'},
+        }})
+        set_config_mock.assert_called_once_with('root', {'SYNC_ACL': 'yes', 'FOOBAR': '1234'})
+
+        set_config_mock.reset_mock()
+        self.assertEqual(snapper.set_config(**opts), {'root': {}})
+        self.assertFalse(set_config_mock.called)
+
+        snapper.set_config(name=['root', 'home'], number_limit=20)
+        self.assertEqual(set_config_mock.call_count, 2)
+
+    def test_get_counters(self):
+        snapper.get_counters(reset=True)
+        snapper._COUNTERS['dbus_calls'] += 2  # pylint: disable=protected-access
+        with patch('salt.utils.fopen', mock_open(read_data="dummy text")):
+            self.assertEqual(snapper._read_lines('/tmp/foo'), ['dummy text'])  # pylint: disable=protected-access
+        self.assertEqual(snapper.get_counters(reset=True), {'dbus_calls': 2, 'bytes_read': 10})
+        self.assertEqual(snapper.get_counters(), {'dbus_calls': 0, 'bytes_read': 0})
 
     def test_status_to_string(self):
         self.assertEqual(snapper.status_to_string(1), ["created"])
@@ -216,6 +317,38 @@ class SnapperTestCase(TestCase):
             self.assertEqual(snapper.run("test.ping"), True)
             self.assertRaises(CommandExecutionError, snapper.run, "unknown.func")
 
+    @patch('threading.Thread')
+    def test_run_background_comparison(self, thread_mock):
+        patch_dict = {
+            'snapper.create_snapshot': MagicMock(side_effect=[42, 43]),
+            'test.ping': MagicMock(return_value=True),
+        }
+        with patch.dict(snapper.__salt__, patch_dict):
+            self.assertEqual(snapper.run("test.ping", background_comparison=True), True)
+            self.assertEqual(thread_mock.call_args[1]['args'], ('root', 42, 43))
+            self.assertTrue(thread_mock.return_value.start.called)
+
+    def test__get_files_status_cached(self):
+        cachedir = tempfile.mkdtemp()
+        try:
+            with patch.dict(snapper.__opts__, {'cachedir': cachedir}):
+                snapper.snapper.GetSnapshot.return_value = DBUS_RET['ListSnapshots'][0]
+                snapper.snapper.GetFiles.return_value = DBUS_RET['GetFiles']
+                files = dict(DBUS_RET['GetFiles'])
+                self.assertEqual(snapper._get_files_status('root', 42, 43), files)  # pylint: disable=protected-access
+                self.assertEqual(snapper._get_files_status('root', 42, 43), files)  # pylint: disable=protected-access
+                self.assertEqual(snapper.snapper.GetFiles.call_count, 1)
+
+                # Snapshot numbers reused by newer snapshots are compared again
+                snapper.snapper.GetSnapshot.return_value = DBUS_RET['ListSnapshots'][1]
+                self.assertEqual(snapper._get_files_status('root', 42, 43), files)  # pylint: disable=protected-access
+                self.assertEqual(snapper.snapper.GetFiles.call_count, 2)
+
+                snapper._cache_invalidate('root', [42])  # pylint: disable=protected-access
+                self.assertEqual(os.listdir(os.path.join(cachedir, 'snapper', 'comparison')), [])
+        finally:
+            shutil.rmtree(cachedir)
+
     @patch('salt.modules.snapper._get_num_interval', MagicMock(return_value=(42, 43)))
     @patch('salt.modules.snapper.snapper.GetComparison', MagicMock())
     @patch('salt.modules.snapper.snapper.GetFiles', MagicMock(return_value=DBUS_RET['GetFiles']))
@@ -225,6 +358,41 @@ class SnapperTestCase(TestCase):
         self.assertItemsEqual(snapper.status(num_pre=42), MODULE_RET['GETFILES'])
         self.assertItemsEqual(snapper.status(num_post=43), MODULE_RET['GETFILES'])
 
+    @patch('salt.modules.snapper._get_num_interval', MagicMock(return_value=(42, 43)))
+    @patch('salt.modules.snapper.snapper.GetFiles', MagicMock(return_value=DBUS_RET['GetFiles']))
+    def test_status_compact(self):
+        module_ret = {
+            'format': snapper.COMPACT_FORMAT,
+            'status': {
+                '/root': {'.viminfo': 8},
+                '/tmp': {'foo': 52, 'foo2': 1, 'foo3': 2},
+                '/var/log': {'snapper.log': 8},
+                '/var/cache/salt/minion/extmods/modules': {'snapper.py': 8, 'snapper.pyc': 8},
+            }
+        }
+        self.assertEqual(snapper.status(compact=True), module_ret)
+        self.assertEqual(snapper.changed_files(compact=True)['files']['/tmp'], ['foo', 'foo2', 'foo3'])
+
+    @patch('salt.modules.snapper._get_num_interval', MagicMock(return_value=(42, 43)))
+    @patch('salt.modules.snapper.snapper.GetFiles', MagicMock(return_value=DBUS_RET['GetFiles']))
+    def test_status_rollup(self):
+        self.assertEqual(snapper.status(rollup_depth=1), {
+            '/root/*': {'files': 1, 'status': {'modified': 1}},
+            '/tmp/*': {'files': 3, 'status': {'type changed': 1, 'permission changed': 1,
+                                              'owner changed': 1, 'created': 1, 'deleted': 1}},
+            '/var/*': {'files': 3, 'status': {'modified': 3}},
+        })
+        self.assertEqual(snapper.status(rollup_threshold=2), {
+            '/root/.viminfo': {'status': ['modified']},
+            '/tmp/*': {'files': 3, 'status': {'type changed': 1, 'permission changed': 1,
+                                              'owner changed': 1, 'created': 1, 'deleted': 1}},
+            '/var/log/snapper.log': {'status': ['modified']},
+            '/var/cache/salt/minion/extmods/modules/snapper.py': {'status': ['modified']},
+            '/var/cache/salt/minion/extmods/modules/snapper.pyc': {'status': ['modified']},
+        })
+        self.assertEqual(snapper.status(path='/var/log/'), {'/var/log/snapper.log': {'status': ['modified']}})
+        self.assertRaises(CommandExecutionError, snapper.status, compact=True, rollup_depth=1)
+
     @patch('salt.modules.snapper.status', MagicMock(return_value=MODULE_RET['GETFILES']))
     def test_changed_files(self):
         self.assertEqual(snapper.changed_files(), MODULE_RET['GETFILES'].keys())
@@ -247,13 +415,173 @@ class SnapperTestCase(TestCase):
             module_ret = {'create': '1', 'delete': '1', 'modify': '1'}
             self.assertEqual(snapper.undo(files=['/tmp/foo', '/tmp/foo2', '/tmp/foo3']), module_ret)
 
-    @patch('salt.modules.snapper.list_snapshots', MagicMock(return_value=MODULE_RET['SNAPSHOTS']))
+    @patch('salt.modules.snapper._get_num_interval', MagicMock(return_value=(42, 43)))
+    @patch('salt.modules.snapper.status', MagicMock(return_value=MODULE_RET['GETFILES']))
+    def test_undo_workers(self):
+        def _cmd_run(cmd):
+            return 'create:1 modify:{0} delete:0'.format(len(cmd.split(' ')) - 3)
+
+        with patch.dict(snapper.__salt__, {'cmd.run': MagicMock(side_effect=_cmd_run)}):
+            ret = snapper.undo(workers=4)
+            self.assertEqual(sorted(ret['shards']), ['/root', '/tmp', '/var'])
+            self.assertEqual(ret['shards']['/tmp']['files'], 3)
+            self.assertEqual(ret['shards']['/var']['modify'], '3')
+            self.assertEqual((ret['create'], ret['modify'], ret['delete']), ('3', '7', '0'))
+
+        with patch.dict(snapper.__salt__, {'cmd.run': MagicMock(side_effect=_cmd_run)}) as salt_mock:
+            ret = snapper.undo(workers=2)
+            # One snapper undochange, and so one comparison, per worker
+            self.assertEqual(salt_mock['cmd.run'].call_count, 2)
+            self.assertEqual(len(ret['shards']), 2)
+            self.assertEqual(ret['modify'], '7')
+
+    @patch('salt.modules.snapper._get_num_interval', MagicMock(return_value=(42, 43)))
+    @patch('salt.modules.snapper.status', MagicMock(return_value=MODULE_RET['GETFILES']))
+    @patch('salt.modules.snapper.time.sleep', MagicMock())
+    def test_undo_throttle(self):
+        cmd_mock = MagicMock(return_value='create:0 modify:2 delete:0')
+        with patch.dict(snapper.__salt__, {'cmd.run': cmd_mock}):
+            ret = snapper.undo(files=['/tmp/foo', '/tmp/foo2', '/tmp/foo3', '/root/.viminfo'],
+                               throttle={'nice': 19, 'ionice': 'idle', 'files_per_second': 2})
+            self.assertEqual(cmd_mock.call_count, 1)
+            self.assertTrue(cmd_mock.call_args_list[0][0][0].startswith(
+                'nice -n 19 ionice -c 3 snapper undochange 42..43 '))
+            self.assertEqual(ret['modify'], '2')
+            self.assertEqual(ret['throttle']['files'], 4)
+
+        self.assertRaises(CommandExecutionError, snapper.undo, files=['/tmp/foo'],
+                          throttle={'ionice': 'realtime'})
+
+    @patch('salt.modules.snapper._get_num_interval', MagicMock(return_value=(42, 43)))
+    @patch('salt.modules.snapper.time.sleep')
+    def test_undo_created_directory(self, sleep_mock):
+        changes = {'/tmp/dir': {'status': ['created']},
+                   '/tmp/dir/foo': {'status': ['created']}}
+        cmd_mock = MagicMock(return_value='create:2 modify:0 delete:0')
+        with patch('salt.modules.snapper.status', MagicMock(return_value=changes)), \
+                patch.dict(snapper.__salt__, {'cmd.run': cmd_mock}):
+            ret = snapper.undo(throttle={'files_per_second': 1})
+        # The directory and its contents are restored by the same call
+        self.assertEqual(cmd_mock.call_count, 1)
+        self.assertEqual(sorted(cmd_mock.call_args[0][0].split(' ')[3:]),
+                         ['/tmp/dir', '/tmp/dir/foo'])
+        self.assertEqual(ret['create'], '2')
+        self.assertEqual(ret['throttle']['files'], 2)
+        self.assertFalse(sleep_mock.called)
+
+    @patch('os.nice', MagicMock(return_value=0))
+    def test__throttle_renice_once(self):
+        run_mock = MagicMock()
+        with patch.dict(snapper.__salt__, {'cmd.run_all': run_mock}):
+            for _ in range(3):
+                snapper._get_throttle({'nice': 10, 'ionice': 'idle'}).renice()  # pylint: disable=protected-access
+        self.assertEqual(run_mock.call_count, 1)
+        self.assertEqual(os.nice.call_count, 2)
+
+    def test__pack_shards(self):
+        shards = {'/etc': ['/etc/a', '/etc/b', '/etc/c'], '/tmp': ['/tmp/dir', '/tmp/dir/foo'],
+                  '/var': ['/var/x'], '/vmlinuz': ['/vmlinuz']}
+        groups = snapper._pack_shards(shards, 2)  # pylint: disable=protected-access
+        self.assertEqual(sorted(groups), ['/etc,/vmlinuz', '/tmp,/var'])
+        self.assertEqual(groups['/tmp,/var'], ['/tmp/dir', '/tmp/dir/foo', '/var/x'])
+        self.assertEqual(len(snapper._pack_shards(shards, 8)), 4)  # pylint: disable=protected-access
+
+    def test__shard_by_top_dir(self):
+        shards = snapper._shard_by_top_dir(['/tmp/dir', '/tmp/dir/foo', '/etc/hosts', '/vmlinuz'])  # pylint: disable=protected-access
+        self.assertEqual(shards, {'/tmp': ['/tmp/dir', '/tmp/dir/foo'], '/etc': ['/etc/hosts'], '/vmlinuz': ['/vmlinuz']})
+
+    @patch('salt.modules.snapper.snapper.ListSnapshots', MagicMock(return_value=DBUS_RET['ListSnapshots']))
     def test__get_jid_snapshots(self):
         self.assertEqual(
             snapper._get_jid_snapshots("20160607130930720112"),  # pylint: disable=protected-access
             (MODULE_RET['SNAPSHOTS'][0]['id'], MODULE_RET['SNAPSHOTS'][1]['id'])
         )
 
+    @patch('salt.modules.snapper._version', MagicMock(side_effect=lambda config, path, number: 'sha{0}'.format(number)))
+    def test_file_history(self):
+        snapper.snapper.ListSnapshots.return_value = [
+            [number, 0, 0, 1457006570 + number, 0, 'snapshot {0}'.format(number), '', {}]
+            for number in range(1, 17)
+        ]
+
+        def _files_status(config, pre, post):  # pylint: disable=unused-argument
+            changed = any(pre < number <= post for number in (4, 7))
+            return {'/etc/sudoers': 8} if changed else {'/etc/motd': 8}
+
+        status_mock = MagicMock(side_effect=_files_status)
+        with patch('salt.modules.snapper._get_files_status', status_mock):
+            ret = snapper.file_history('/etc/sudoers', num_post=16)
+        self.assertEqual([version['snapshot'] for version in ret['versions']], [1, 4, 7])
+        self.assertEqual(ret['versions'][1], {
+            'snapshot': 4, 'pre': 3, 'timestamp': 1457006574, 'description': 'snapshot 4',
+            'status': ['modified'], 'sha256_digest': 'sha4'})
+        self.assertLess(status_mock.call_count, 15)
+
+        self.assertRaises(CommandExecutionError, snapper.file_history, '/etc/sudoers', num_pre=20)
+
+    @patch('salt.modules.snapper._version', MagicMock(return_value='sha'))
+    def test_file_history_exact(self):
+        snapper.snapper.ListSnapshots.return_value = [
+            [number, 0, 0, 1457006570 + number, 0, '', '', {}] for number in range(1, 4)
+        ]
+
+        def _files_status(config, pre, post):  # pylint: disable=unused-argument
+            # Edited in snapshot 2 and restored in snapshot 3
+            return {'/etc/sudoers': 8} if (pre, post) in ((1, 2), (2, 3)) else {}
+
+        with patch('salt.modules.snapper._get_files_status', MagicMock(side_effect=_files_status)):
+            ret = snapper.file_history('/etc/sudoers', num_pre=1, num_post=3)
+            self.assertEqual([version['snapshot'] for version in ret['versions']], [1])
+            ret = snapper.file_history('/etc/sudoers', num_pre=1, num_post=3, exact=True)
+            self.assertEqual([version['snapshot'] for version in ret['versions']], [1, 2, 3])
+
+    def test_undo_jids(self):
+        snapper.snapper.ListSnapshots.return_value = [
+            [42, 1, 0, 1457006571, 0, '', '', {'salt_jid': 'jid1'}],
+            [43, 2, 42, 1457006572, 0, '', '', {'salt_jid': 'jid1'}],
+            [44, 1, 0, 1457006573, 0, '', '', {'salt_jid': 'jid2'}],
+            [45, 2, 44, 1457006574, 0, '', '', {'salt_jid': 'jid2'}],
+        ]
+        comparisons = {
+            (42, 43): {'/etc/motd': 8, '/tmp/foo': 1},
+            (44, 45): {'/etc/motd': 8, '/tmp/foo': 2, '/etc/hosts': 8},
+            (42, 45): {'/etc/motd': 8, '/etc/hosts': 8},
+        }
+        cmd_mock = MagicMock(side_effect=lambda cmd: 'create:0 modify:{0} delete:0'.format(len(cmd.split(' ')) - 3))
+        with patch('salt.modules.snapper._get_files_status',
+                   MagicMock(side_effect=lambda config, pre, post: comparisons[(pre, post)])), \
+                patch.dict(snapper.__salt__, {'cmd.run': cmd_mock}):
+            ret = snapper.undo_jids('jid1,jid2')
+        cmd_mock.assert_any_call('snapper undochange 42..45 /etc/motd')
+        cmd_mock.assert_any_call('snapper undochange 44..45 /etc/hosts')
+        self.assertEqual(cmd_mock.call_count, 2)
+        self.assertEqual(ret['unchanged'], ['/tmp/foo'])
+        self.assertEqual(ret['jids']['jid2']['files'], ['/etc/hosts', '/etc/motd', '/tmp/foo'])
+        self.assertEqual(ret['modify'], '2')
+
+        self.assertRaises(CommandExecutionError, snapper.undo_jids, ['jid1', 'jid3'])
+
+    def test_undo_jids_newest_first(self):
+        snapper.snapper.ListSnapshots.return_value = [
+            [10, 1, 0, 1457006571, 0, '', '', {'salt_jid': 'jid1'}],
+            [11, 2, 10, 1457006572, 0, '', '', {'salt_jid': 'jid1'}],
+            [12, 1, 0, 1457006573, 0, '', '', {'salt_jid': 'jid2'}],
+            [13, 2, 12, 1457006574, 0, '', '', {'salt_jid': 'jid2'}],
+        ]
+        # jid1 creates the /d directory and jid2 creates /d/f into it
+        comparisons = {
+            (10, 11): {'/d': 1},
+            (12, 13): {'/d/f': 1},
+        }
+        cmd_mock = MagicMock(return_value='create:0 modify:0 delete:1')
+        with patch('salt.modules.snapper._get_files_status',
+                   MagicMock(side_effect=lambda config, pre, post: comparisons[(pre, post)])), \
+                patch.dict(snapper.__salt__, {'cmd.run': cmd_mock}):
+            ret = snapper.undo_jids(['jid1', 'jid2'])
+        self.assertEqual([call[0][0] for call in cmd_mock.call_args_list],
+                         ['snapper undochange 12..13 /d/f', 'snapper undochange 10..11 /d'])
+        self.assertEqual(ret['delete'], '2')
+
     @patch('salt.modules.snapper._get_jid_snapshots', MagicMock(return_value=(42, 43)))
     @patch('salt.modules.snapper.undo', MagicMock(return_value='create:1 modify:1 delete:1'))
     def test_undo_jid(self):
@@ -263,7 +591,7 @@ class SnapperTestCase(TestCase):
     @patch('salt.modules.snapper.snapper.MountSnapshot', MagicMock(side_effect=["/.snapshots/55/snapshot", ""]))
     @patch('salt.modules.snapper.snapper.UmountSnapshot', MagicMock(return_value=""))
     @patch('os.path.isdir', MagicMock(return_value=False))
-    @patch('salt.modules.snapper.changed_files', MagicMock(return_value=["/tmp/foo2"]))
+    @patch('salt.modules.snapper._get_files_status', MagicMock(return_value={"/tmp/foo2": 1}))
     @patch('salt.modules.snapper._is_text_file', MagicMock(return_value=True))
     @patch('os.path.isfile', MagicMock(side_effect=[False, True]))
     @patch('salt.utils.fopen', mock_open(read_data=FILE_CONTENT["/tmp/foo2"]['post']))
@@ -274,7 +602,8 @@ class SnapperTestCase(TestCase):
     @patch('salt.modules.snapper.snapper.MountSnapshot', MagicMock(
         side_effect=["/.snapshots/55/snapshot", "", "/.snapshots/55/snapshot", ""]))
     @patch('salt.modules.snapper.snapper.UmountSnapshot', MagicMock(return_value=""))
-    @patch('salt.modules.snapper.changed_files', MagicMock(return_value=["/tmp/foo", "/tmp/foo2"]))
+    @patch('salt.modules.snapper._get_files_status', MagicMock(return_value={"/tmp/foo": 8, "/tmp/foo2": 1}))
+    @patch('salt.modules.snapper._same_content', MagicMock(return_value=False))
     @patch('salt.modules.snapper._is_text_file', MagicMock(return_value=True))
     @patch('os.path.isfile', MagicMock(side_effect=[True, True, False, True]))
     @patch('os.path.isdir', MagicMock(return_value=False))
@@ -292,31 +621,278 @@ class SnapperTestCase(TestCase):
             }
             self.assertEqual(snapper.diff(), module_ret)
 
+    @patch('salt.modules.snapper._get_num_interval', MagicMock(return_value=(55, 0)))
+    @patch('salt.modules.snapper.snapper.MountSnapshot', MagicMock(return_value="/.snapshots/55/snapshot"))
+    @patch('salt.modules.snapper.snapper.UmountSnapshot', MagicMock(return_value=""))
+    @patch('salt.modules.snapper._get_files_status', MagicMock(return_value={'/tmp/a': 16, '/tmp/b': 32, '/tmp/c': 64}))
+    @patch('os.path.isdir', MagicMock(return_value=False))
+    def test_diff_timeout(self):
+        with patch.object(snapper._Deadline, 'expired', MagicMock(side_effect=[False, False, True])):  # pylint: disable=protected-access
+            ret = snapper.diff(timeout=60)
+        self.assertEqual(sorted(ret), ['/tmp/a', '/tmp/b', 'incomplete'])
+        self.assertEqual(ret['incomplete'], {'reason': 'timeout', 'cursor': '/tmp/b',
+                                             'num_pre': 55, 'num_post': 0})
+        self.assertTrue(snapper.snapper.UmountSnapshot.called)
+
+        self.assertEqual(sorted(snapper.diff(num_pre=55, num_post=0, cursor='/tmp/b')), ['/tmp/c'])
+
+    @patch('salt.modules.snapper._get_num_interval', MagicMock(return_value=(42, 0)))
+    def test_status_timeout(self):
+        def _compare(*args, **kwargs):  # pylint: disable=unused-argument
+            time.sleep(0.5)
+            return {'/tmp/foo': 8}
+
+        with patch('salt.modules.snapper._get_files_status', MagicMock(side_effect=_compare)):
+            self.assertEqual(snapper.status(timeout=0.01), {
+                'incomplete': {'reason': 'timeout', 'num_pre': 42, 'num_post': 0, 'cursor': None}})
+            self.assertEqual(snapper.status(timeout=5), {'/tmp/foo': {'status': ['modified']}})
+
     @patch('salt.modules.snapper._get_num_interval', MagicMock(return_value=(55, 0)))
     @patch('salt.modules.snapper.snapper.MountSnapshot', MagicMock(
         side_effect=["/.snapshots/55/snapshot", "", "/.snapshots/55/snapshot", ""]))
     @patch('salt.modules.snapper.snapper.UmountSnapshot', MagicMock(return_value=""))
-    @patch('salt.modules.snapper.changed_files', MagicMock(return_value=["/tmp/foo3"]))
+    @patch('salt.modules.snapper._get_files_status', MagicMock(return_value={"/tmp/foo3": 8}))
+    @patch('salt.modules.snapper._same_content', MagicMock(return_value=False))
     @patch('salt.modules.snapper._is_text_file', MagicMock(return_value=False))
     @patch('os.path.isfile', MagicMock(side_effect=[True, True]))
     @patch('os.path.isdir', MagicMock(return_value=False))
-    @patch.dict(snapper.__salt__, {
-        'hashutil.sha256_digest': MagicMock(side_effect=[
-            "e61f8b762d83f3b4aeb3689564b0ffbe54fa731a69a1e208dc9440ce0f69d19b",
-            "f18f971f1517449208a66589085ddd3723f7f6cefb56c141e3d97ae49e1d87fa",
-        ])
-    })
     def test_diff_binary_files(self):
-        fopen_effect = [
-            mock_open(read_data="dummy binary").return_value,
-            mock_open(read_data="dummy binary").return_value,
-        ]
-        with patch('salt.utils.fopen') as fopen_mock:
-            fopen_mock.side_effect = fopen_effect
+        delta_mock = MagicMock(return_value={
+            'old_sha256_digest': MODULE_RET['DIFF']['/tmp/foo3']['old_sha256_digest'],
+            'new_sha256_digest': MODULE_RET['DIFF']['/tmp/foo3']['new_sha256_digest'],
+        })
+        with patch('salt.modules.snapper._binary_delta', delta_mock):
             module_ret = {
                 "/tmp/foo3": MODULE_RET['DIFF']["/tmp/foo3"],
             }
             self.assertEqual(snapper.diff(), module_ret)
+            delta_mock.assert_called_once_with('/.snapshots/55/snapshot/tmp/foo3', '/tmp/foo3', None)
+
+    def test__binary_delta(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            pre_data = bytes(bytearray((number * 7919) % 251 for number in range(64 * 1024)))
+            post_data = pre_data[:10000] + b'inserted' + pre_data[10000:40960] + b'x' * 4096 + pre_data[45056:]
+            for name, data in (('pre', pre_data), ('post', post_data)):
+                with open(os.path.join(tmpdir, name), 'wb') as file_:
+                    file_.write(data)
+            with patch('salt.utils.fopen', open):
+                delta = snapper._binary_delta(os.path.join(tmpdir, 'pre'), os.path.join(tmpdir, 'post'))  # pylint: disable=protected-access
+        finally:
+            shutil.rmtree(tmpdir)
+
+        self.assertEqual(delta['old_sha256_digest'], hashlib.sha256(pre_data).hexdigest())
+        self.assertEqual(delta['new_sha256_digest'], hashlib.sha256(post_data).hexdigest())
+        self.assertEqual(delta['block_size'], 4096)
+        self.assertTrue(delta['bytes_changed'] < 3 * 4096)
+        self.assertTrue(delta['changed_ranges'][0][0] <= 10000 < delta['changed_ranges'][0][1])
+        self.assertTrue(delta['percent_changed'] < 20)
+
+    @patch('salt.modules.snapper._get_num_interval', MagicMock(return_value=(55, 0)))
+    @patch('salt.modules.snapper.snapper.MountSnapshot', MagicMock(return_value="/.snapshots/55/snapshot"))
+    @patch('salt.modules.snapper.snapper.UmountSnapshot', MagicMock(return_value=""))
+    @patch('salt.modules.snapper._get_files_status', MagicMock(return_value={"/tmp/foo": 48, "/tmp/foo2": 8}))
+    @patch('salt.modules.snapper._same_content', MagicMock(return_value=True))
+    @patch('os.path.isfile', MagicMock(return_value=True))
+    @patch('os.path.isdir', MagicMock(return_value=False))
+    def test_diff_metadata_only(self):
+        with patch('salt.utils.fopen') as fopen_mock:
+            module_ret = {
+                "/tmp/foo": {'comment': 'file metadata changed'},
+                "/tmp/foo2": {'comment': 'file metadata changed'},
+            }
+            self.assertEqual(snapper.diff(), module_ret)
+            self.assertFalse(fopen_mock.called)
+
+    @patch('os.stat')
+    def test__same_content(self, stat_mock):
+        stat_mock.side_effect = [MagicMock(st_size=10), MagicMock(st_size=12)]
+        self.assertFalse(snapper._same_content('/pre/foo', '/post/foo'))  # pylint: disable=protected-access
+
+        stat_mock.side_effect = None
+        stat_mock.return_value = MagicMock(st_size=10)
+        fopen_effect = [
+            mock_open(read_data="dummy text").return_value,
+            mock_open(read_data="dummy text").return_value,
+        ]
+        with patch('salt.utils.fopen', MagicMock(side_effect=fopen_effect)):
+            self.assertTrue(snapper._same_content('/pre/foo', '/post/foo'))  # pylint: disable=protected-access
+
+    def test__unified_diff(self):
+        pre_lines = ['line {0}\n'.format(i) for i in range(100)]
+        post_lines = list(pre_lines)
+        post_lines[50] = 'changed\n'
+        diff, added, removed, truncated = snapper._unified_diff(  # pylint: disable=protected-access
+            pre_lines, post_lines, 'pre', 'post', context=1)
+        self.assertEqual(diff, "--- pre\n+++ post\n@@ -50,3 +50,3 @@\n"
+                               " line 49\n-line 50\n+changed\n line 51\n")
+        self.assertEqual((added, removed, truncated), (1, 1, False))
+
+        diff, added, removed, truncated = snapper._unified_diff(  # pylint: disable=protected-access
+            pre_lines, [], 'pre', 'post', max_diff_lines=4)
+        self.assertEqual(diff, "--- pre\n+++ post\n@@ -1,100 +0,0 @@\n-line 0\n")
+        self.assertEqual((added, removed, truncated), (0, 100, True))
+
+    @patch('salt.modules.snapper._get_num_interval', MagicMock(return_value=(42, 43)))
+    @patch('salt.modules.snapper.snapper.MountSnapshot', MagicMock(side_effect=["/.snapshots/55/snapshot", ""]))
+    @patch('salt.modules.snapper.snapper.UmountSnapshot', MagicMock(return_value=""))
+    @patch('os.path.isdir', MagicMock(return_value=False))
+    @patch('salt.modules.snapper._get_files_status', MagicMock(return_value={"/tmp/foo2": 1}))
+    @patch('salt.modules.snapper._is_text_file', MagicMock(return_value=True))
+    @patch('os.path.isfile', MagicMock(side_effect=[False, True]))
+    @patch('salt.utils.fopen', mock_open(read_data=FILE_CONTENT["/tmp/foo2"]['post']))
+    def test_diff_summary_only(self):
+        module_ret = {'comment': 'text file created', 'lines_added': 1, 'lines_removed': 0}
+        self.assertEqual(snapper.diff(summary_only=True), {"/tmp/foo2": module_ret})
+
+    def test__diff_cache(self):
+        cachedir = tempfile.mkdtemp()
+        try:
+            with patch.dict(snapper.__opts__, {'cachedir': cachedir, 'snapper.diff_cache_size': 1000}):
+                self.assertIsNone(snapper._diff_cache_get('root.42.43.a.json'))  # pylint: disable=protected-access
+                snapper._diff_cache_set('root.42.43.a.json', MODULE_RET['DIFF'])  # pylint: disable=protected-access
+                self.assertEqual(snapper._diff_cache_get('root.42.43.a.json'), MODULE_RET['DIFF'])  # pylint: disable=protected-access
+
+                # Over the size limit the least recently used entries are evicted
+                snapper._diff_cache_set('root.43.44.b.json', MODULE_RET['DIFF'])  # pylint: disable=protected-access
+                self.assertIsNone(snapper._diff_cache_get('root.42.43.a.json'))  # pylint: disable=protected-access
+                self.assertIsNotNone(snapper._diff_cache_get('root.43.44.b.json'))  # pylint: disable=protected-access
+
+                snapper._cache_invalidate('root', [44])  # pylint: disable=protected-access
+                self.assertEqual(os.listdir(os.path.join(cachedir, 'snapper', 'diff')), [])
+        finally:
+            shutil.rmtree(cachedir)
+
+    @patch('salt.modules.snapper._get_num_interval', MagicMock(return_value=(42, 43)))
+    @patch('salt.modules.snapper._diff_cache_key', MagicMock(return_value='root.42.43.a.json'))
+    @patch('salt.modules.snapper._diff_cache_get', MagicMock(return_value=MODULE_RET['DIFF']))
+    @patch('salt.modules.snapper.snapper.MountSnapshot')
+    def test_diff_cached(self, mount_mock):
+        self.assertEqual(snapper.diff(), MODULE_RET['DIFF'])
+        self.assertFalse(mount_mock.called)
+
+        compact_ret = snapper.diff(compact=True)
+        self.assertEqual(compact_ret['format'], snapper.COMPACT_FORMAT)
+        self.assertEqual(sorted(compact_ret['diff']['/tmp'].keys()), ['foo', 'foo2', 'foo3'])
+        self.assertNotEqual(compact_ret['diff']['/tmp']['foo']['diff'], MODULE_RET['DIFF']['/tmp/foo']['diff'])
+
+    def test_prune(self):
+        now = int(time.time())
+        snapper.snapper.ListSnapshots.return_value = [
+            [40, 0, 0, now - 300, 0, 'baseline snapshot', 'number', {'baseline_tag': 'baseline'}],
+            [41, 0, 0, now - 200, 0, 'baseline snapshot', 'number', {'baseline_tag': 'baseline'}],
+            [42, 1, 0, now - 100, 0, 'salt job', 'number', {'salt_jid': '1'}],
+            [43, 2, 42, now - 100, 0, 'salt job', 'number', {'salt_jid': '1'}],
+            [44, 1, 0, now - 10, 0, 'salt job', 'number', {'salt_jid': '2'}],
+            [45, 2, 44, now - 10, 0, 'salt job', 'number', {'salt_jid': '2'}],
+            [46, 0, 0, now, 0, 'timeline', 'timeline', {}],
+        ]
+        snapper.snapper.GetUsedSpace.side_effect = lambda config, number: number * 10
+
+        ret = snapper.prune(keep_jids=1, keep_baselines=1, test=True)
+        self.assertEqual(ret['snapshots'], {
+            40: {'reason': 'keep_baselines', 'size': 400},
+            42: {'reason': 'keep_jids', 'size': 420},
+            43: {'reason': 'keep_jids', 'size': 430},
+        })
+        self.assertEqual(ret['reclaimed'], 1250)
+        self.assertFalse(snapper.snapper.DeleteSnapshots.called)
+
+        with patch('salt.modules.snapper._get_files_status', MagicMock(side_effect=[{'/tmp/foo': 8}, {}])):
+            ret = snapper.prune(drop_empty=True, max_age=50)
+        self.assertEqual(sorted(ret['snapshots']), [42, 43])
+        self.assertEqual(ret['snapshots'][42]['reason'], 'max_age')
+        snapper.snapper.DeleteSnapshots.assert_called_once_with('root', [42, 43])
+
+        ret = snapper.prune(space_budget=900, test=True)
+        self.assertEqual(sorted(ret['snapshots']), [42, 43])
+        self.assertEqual(ret['snapshots'][43]['reason'], 'space_budget')
+
+    @patch('salt.modules.snapper._get_num_interval', MagicMock(return_value=(42, 43)))
+    @patch('salt.modules.snapper._get_files_status', MagicMock(return_value={'/tmp/foo': 8, '/tmp/foo2': 1,
+                                                                              '/tmp/foo3': 2}))
+    def test_export(self):
+        cachedir = tempfile.mkdtemp()
+        snapshot_dir = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(snapshot_dir, 'tmp'))
+            for name in ('foo', 'foo2'):
+                with open(os.path.join(snapshot_dir, 'tmp', name), 'w') as file_:
+                    file_.write(FILE_CONTENT['/tmp/' + name]['post'])
+
+            with patch.dict(snapper.__opts__, {'cachedir': cachedir}), \
+                    patch('salt.modules.snapper._mount_snapshot', MagicMock(return_value=snapshot_dir)), \
+                    patch('salt.modules.snapper._umount_snapshot', MagicMock()):
+                ret = snapper.export(part_size=1)
+                self.assertEqual(ret['parts'], ['part-0000.tar.gz', 'part-0001.tar.gz'])
+                self.assertEqual((ret['files'], ret['deleted'], ret['bytes']), (2, 1, 28))
+                self.assertFalse(ret['resumed'])
+
+                tar = tarfile.open(os.path.join(ret['directory'], 'part-0000.tar.gz'))
+                self.assertEqual(tar.getnames(), ['MANIFEST.json', 'tmp/foo'])
+                manifest = json.loads(tar.extractfile('MANIFEST.json').read().decode('utf-8'))
+                self.assertEqual(manifest['deleted'], ['/tmp/foo3'])
+                self.assertEqual(tar.extractfile('tmp/foo').read().decode('utf-8'), 'another foobar')
+                tar.close()
+
+                # Simulate an export interrupted after the first part
+                progress_path = os.path.join(ret['directory'], 'progress.json')
+                with open(progress_path, 'w') as progress_file:
+                    json.dump({'compression': 'gz', 'done': 1, 'parts': ['part-0000.tar.gz'],
+                               'files': 1, 'bytes': 14}, progress_file)
+                ret = snapper.export(part_size=1)
+                self.assertTrue(ret['resumed'])
+                self.assertEqual((ret['parts'], ret['files']), (['part-0000.tar.gz', 'part-0001.tar.gz'], 2))
+
+                # Starting over removes the parts of the previous export
+                ret = snapper.export(compression='bz2', part_size=1024)
+                self.assertFalse(ret['resumed'])
+                self.assertEqual(sorted(os.listdir(ret['directory'])), ['part-0000.tar.bz2', 'progress.json'])
+        finally:
+            shutil.rmtree(cachedir)
+            shutil.rmtree(snapshot_dir)
+
+    def test_verify_baseline(self):
+        tmpdir = tempfile.mkdtemp()
+        snapshot_dir = os.path.join(tmpdir, 'snapshot')
+        live_dir = os.path.join(tmpdir, 'live')
+        try:
+            for root in (snapshot_dir, live_dir):
+                os.makedirs(os.path.join(root, 'etc', 'conf.d'))
+                for name, content in (('hosts', 'localhost'), ('motd', 'hello'),
+                                      ('conf.d/a', 'a'), ('conf.d/b', 'b')):
+                    with open(os.path.join(root, 'etc', name), 'w') as file_:
+                        file_.write(content)
+                    os.utime(os.path.join(root, 'etc', name), (1457006571, 1457006571))
+            with open(os.path.join(live_dir, 'etc', 'motd'), 'w') as file_:
+                file_.write('HELLO')
+            os.utime(os.path.join(live_dir, 'etc', 'conf.d', 'a'), None)
+            os.chmod(os.path.join(live_dir, 'etc', 'conf.d', 'b'), 0o600)
+            os.remove(os.path.join(live_dir, 'etc', 'hosts'))
+            with open(os.path.join(live_dir, 'etc', 'new'), 'w') as file_:
+                file_.write('new')
+
+            def _mount(config, number):  # pylint: disable=unused-argument
+                return snapshot_dir if number else live_dir
+
+            with patch.dict(snapper.__opts__, {'cachedir': os.path.join(tmpdir, 'cache')}), \
+                    patch.dict(snapper.__salt__, {'snapper.create_snapshot': MagicMock(return_value=7)}), \
+                    patch('salt.modules.snapper._mount_snapshot', MagicMock(side_effect=_mount)), \
+                    patch('salt.modules.snapper._umount_snapshot', MagicMock()), \
+                    patch('salt.utils.fopen', open):
+                self.assertEqual(snapper.create_baseline(manifest='/etc'), 7)
+                ret = snapper.verify_baseline(number=7, workers=2)
+                self.assertRaises(CommandExecutionError, snapper.verify_baseline, number=8)
+        finally:
+            shutil.rmtree(tmpdir)
+
+        self.assertEqual(ret['files'], {
+            '/etc/motd': {'status': ['modified']},
+            '/etc/conf.d/b': {'status': ['permission changed']},
+            '/etc/hosts': {'status': ['deleted']},
+            '/etc/new': {'status': ['created']},
+        })
+        self.assertEqual((ret['baseline'], ret['checked'], ret['hashed']), (7, 4, 2))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+'''
+Unit tests for the Snapper runner
+'''
+
+from __future__ import absolute_import
+
+import base64
+import zlib
+
+from salttesting import TestCase
+from salttesting.mock import (
+    MagicMock,
+    patch,
+)
+from salttesting.helpers import ensure_in_syspath
+ensure_in_syspath('../../')
+
+from salt.runners import snapper
+
+snapper.__opts__ = {'conf_file': '/etc/salt/master', 'timeout': 5}
+
+
+def _compress(text):
+    return base64.b64encode(zlib.compress(text.encode('utf-8'))).decode('ascii')
+
+
+class SnapperRunnerTestCase(TestCase):
+    def test_decode_status(self):
+        data = {
+            'format': snapper.COMPACT_FORMAT,
+            'status': {'/tmp': {'foo': 52, 'foo2': 1}, '/root': {'.viminfo': 8}},
+        }
+        self.assertEqual(snapper.decode(data), {
+            '/root/.viminfo': {'status': ['modified']},
+            '/tmp/foo': {'status': ['type changed', 'permission changed', 'owner changed']},
+            '/tmp/foo2': {'status': ['created']},
+        })
+
+    def test_decode_incomplete(self):
+        incomplete = {'reason': 'timeout', 'num_pre': 42, 'num_post': 0, 'cursor': '/tmp/foo'}
+        data = {
+            'format': snapper.COMPACT_FORMAT,
+            'diff': {'/tmp': {'foo': {'comment': 'file metadata changed'}}},
+            'incomplete': incomplete,
+        }
+        self.assertEqual(snapper.decode(data), {
+            '/tmp/foo': {'comment': 'file metadata changed'},
+            'incomplete': incomplete,
+        })
+
+    def test_decode_changed_files(self):
+        data = {
+            'format': snapper.COMPACT_FORMAT,
+            'files': {'/': ['vmlinuz'], '/tmp': ['foo', 'foo2']},
+        }
+        self.assertEqual(snapper.decode(data), ['/tmp/foo', '/tmp/foo2', '/vmlinuz'])
+
+    def test_decode_diff_minions(self):
+        data = {
+            'minion1': {
+                'format': snapper.COMPACT_FORMAT,
+                'diff': {'/tmp': {'foo2': {'comment': 'text file created', 'diff': _compress('+another foobar')}}},
+            },
+            'minion2': 'Minion did not return',
+        }
+        self.assertEqual(snapper.decode(data), {
+            'minion1': {'/tmp/foo2': {'comment': 'text file created', 'diff': '+another foobar'}},
+            'minion2': 'Minion did not return',
+        })
+
+    def test_batch(self):
+        def _cmd(tgt, fun, arg=None, **kwargs):  # pylint: disable=unused-argument
+            return dict(('minion{0}'.format(number), True) for number in range(1, 6))
+
+        def _cmd_iter(tgt, fun, arg=None, **kwargs):  # pylint: disable=unused-argument
+            if tgt == 'minion2':
+                yield {tgt: {'ret': "ERROR executing 'snapper.undo_jid': Jid snapshots not found",
+                             'retcode': 0}}
+            elif tgt == 'minion3':
+                yield {tgt: {'ret': {'create': '0', 'modify': '0', 'delete': '0'}, 'retcode': 1}}
+            elif tgt == 'minion4':
+                yield {}
+            else:
+                yield {tgt: {'ret': {'create': '0', 'modify': '1', 'delete': '0'}, 'retcode': 0}}
+
+        client = MagicMock()
+        client.return_value.cmd.side_effect = _cmd
+        client.return_value.cmd_iter.side_effect = _cmd_iter
+        ckminions = MagicMock()
+        ckminions.return_value.check_minions.return_value = ['minion{0}'.format(number) for number in range(1, 7)]
+        with patch('salt.client.LocalClient', client), patch('salt.utils.minions.CkMinions', ckminions):
+            ret = snapper.batch('*', 'undo_jid', arg=['20160607130930720112'], concurrency=1,
+                                max_failures=1)
+        self.assertEqual(ret['summary'], {'minions': 5, 'succeeded': 1, 'failed': 2,
+                                          'skipped': 2, 'aborted': True,
+                                          'no_response': ['minion6']})
+        self.assertEqual(ret['minions']['minion1']['ret']['modify'], '1')
+        self.assertEqual(ret['minions']['minion3']['retcode'], 1)
+        self.assertIn('p90', ret['timing'])
+        client.return_value.cmd_iter.assert_any_call('minion1', 'snapper.undo_jid', ['20160607130930720112'],
+                                                     timeout=600, expr_form='list', kwarg={})
+
+    def test_batch_string_return(self):
+        client = MagicMock()
+        client.return_value.cmd.return_value = {'minion1': True}
+        client.return_value.cmd_iter.return_value = iter([{'minion1': {'ret': 'create:0 modify:1 delete:0',
+                                                                       'retcode': 0}}])
+        ckminions = MagicMock()
+        ckminions.return_value.check_minions.return_value = ['minion1']
+        with patch('salt.client.LocalClient', client), patch('salt.utils.minions.CkMinions', ckminions):
+            ret = snapper.batch('minion1', 'run', max_failures=0)
+        self.assertEqual(ret['summary']['succeeded'], 1)
+        self.assertEqual(ret['minions']['minion1']['ret'], 'create:0 modify:1 delete:0')
+
+if __name__ == '__main__':
+    from integration import run_tests
+    run_tests(SnapperRunnerTestCase, needs_daemon=False)